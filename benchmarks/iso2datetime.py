@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Microbenchmark of zonkylla.core.utils.iso2datetime
+
+Timestamps in Zonky format are parsed by dateutil, by the fast path
+without cache and by iso2datetime with cache. Results of all of them
+are compared.
+
+usage:
+python benchmarks/iso2datetime.py [--count=1000000] [--distinct=1000]
+                                  [--dateutil-sample=100000]
+'''
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import random
+from time import perf_counter
+
+import dateutil.parser
+
+from zonkylla.core.utils import datetime2iso, iso2datetime
+
+
+def timestamps(count, distinct):
+    '''List of count timestamps in Zonky format made of distinct values'''
+
+    random.seed(0)
+    start = datetime(2016, 1, 1, tzinfo=timezone(timedelta(hours=1)))
+    values = [datetime2iso(start + timedelta(seconds=random.randrange(3 * 365 * 86400)))
+              for _ in range(distinct)]
+    return [random.choice(values) for _ in range(count)]
+
+
+def measure(name, func, data, count):
+    '''Parse data by func and print time extrapolated to count timestamps'''
+
+    started = perf_counter()
+    result = [func(value) for value in data]
+    seconds = perf_counter() - started
+
+    total = seconds * count / len(data)
+    print('{:<24} {:>10.3f} s {:>10.3f} us/timestamp{}'.format(
+        name, total, seconds / len(data) * 1e6,
+        '' if len(data) == count else '  (measured on {})'.format(len(data))))
+    return result, total
+
+
+def main():
+    '''Run the benchmark'''
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--distinct', type=int, default=1000,
+                        help='distinct values, dates of Zonky repeat a lot')
+    parser.add_argument('--dateutil-sample', type=int, default=100000,
+                        help='timestamps parsed by dateutil, 0 means all')
+    args = parser.parse_args()
+
+    data = timestamps(args.count, args.distinct)
+    sample = data[:args.dateutil_sample or args.count]
+    print('{} timestamps, {} distinct values'.format(args.count, args.distinct))
+
+    expected, dateutil_total = measure('dateutil.parser.parse', dateutil.parser.parse,
+                                       sample, args.count)
+
+    iso2datetime.cache_clear()
+    result, fast_total = measure('fast path (no cache)', iso2datetime.__wrapped__,
+                                 data, args.count)
+    assert result[:len(sample)] == expected
+
+    iso2datetime.cache_clear()
+    result, cached_total = measure('iso2datetime', iso2datetime, data, args.count)
+    assert result[:len(sample)] == expected
+
+    print('speedup: {:.1f}x without cache, {:.1f}x with cache ({})'.format(
+        dateutil_total / fast_total, dateutil_total / cached_total,
+        iso2datetime.cache_info()))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ Feature: Zonkylla init
     And file "./.zonkylla.db" is created
     And there is proper database structure within file "./.zonkylla.db"
     And we see "The database schema was created within file './.zonkylla.db'" on stdout
-    And we see "Schema version is 3" on stdout
+    And we see "Schema version is 6" on stdout
 
   Scenario: Zonkylla init on existing file (without structure)
     Given we have zonkylla installed
@@ -26,3 +26,12 @@ Feature: Zonkylla init
     When we run "zonkylla init"
     Then return code is "1"
     And we see "Old version of database schema, remove file './.zonkylla.db', please." on stderr
+
+  Scenario: Zonkylla init on existing file (with structure to migrate)
+    Given we have zonkylla installed
+    And we have zonkylla configured properly
+    And there is file "./.zonkylla.db" with structure of version "4"
+    When we run "zonkylla init"
+    Then return code is "0"
+    And there is proper database structure within file "./.zonkylla.db"
+    And we see "Database schema was migrated from version 4 to 6" on stdout
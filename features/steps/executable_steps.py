@@ -68,6 +68,25 @@ def step_impl(context, file_name):  # pylint: disable=unused-argument
         cur.execute("UPDATE z_internals SET db_version = -1 WHERE id = 1")
 
 
+@given(u'there is file "{file_name}" with structure of version "{version}"')
+def step_impl(context, file_name, version):  # pylint: disable=unused-argument
+    '''Create file with structure of older version which can be migrated'''
+
+    command = 'zonkylla init'
+    if context.cli_options:
+        command = command + ' ' + context.cli_options
+
+    result = subprocess.run(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    print(result.stdout.decode('utf-8'))
+    print(result.stderr.decode('utf-8'), file=sys.stderr)
+
+    con = sqlite3.connect(file_name)
+    with con:
+        cur = con.cursor()
+        cur.execute("DROP TABLE z_loans_sync")
+        cur.execute("UPDATE z_internals SET db_version = ? WHERE id = 1", [int(version)])
+
+
 @given(u'we provided password "{password}"')
 def step_impl(context, password):  # pylint: disable=unused-argument
     '''Provide password to environment'''
@@ -122,7 +141,7 @@ def step_impl(context, file_name):  # pylint: disable=unused-argument
 
     schema_file = os.path.join(sys.prefix, 'zonkylla', 'data', 'tables.yaml')
     with open(schema_file, 'r') as stream:
-        schema = yaml.load(stream)
+        schema = yaml.safe_load(stream)
         given_names = list(schema.keys())
 
     con = sqlite3.connect(file_name)
@@ -41,6 +41,10 @@ setup(
         'python-dateutil',
         'IPython',
     ],
+    extras_require={
+        # vectorised payment plans of whole portfolio
+        'numpy': ['numpy'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest']
 )
@@ -7,7 +7,7 @@
 
 Usage:
   zonkylla.py [--config=CONFIG] [-d] init
-  zonkylla.py [--config=CONFIG] [-d] [-t] update <user>
+  zonkylla.py [--config=CONFIG] [-d] [-t] [--async] update <user>
   zonkylla.py [--config=CONFIG] [-d] status
   zonkylla.py (-h | --help)
   zonkylla.py [--config=CONFIG] [-d] interactive
@@ -18,6 +18,7 @@ Options:
   --config=CONFIG   Configuration file [default: ./zonkylla.conf].
   -d                Debugging output.
   -t                Connect to mock server.
+  --async           Download data concurrently using asyncio.
   -h --help         Show this screen.
   --api-version     Show version of supported zonky.cz API version.
   --version         Show version.
@@ -33,9 +34,8 @@ import pkg_resources
 
 from .core.config import Config
 from .core.zonky import Zonky
-from .core.database import DBCreator
+from .core.database import DBCreator, IdentityMap
 from .update import update_from_zonky
-from .core.models import Wallet
 
 
 def get_host(args):
@@ -97,11 +97,14 @@ def main():
         username = args['<user>']
         password = get_password()
 
-        update_from_zonky(host, username, password)
+        update_from_zonky(host, username, password, args['--async'])
         return
 
     if args['status']:
 
+        # models read the schema of database when they are imported
+        from .core.models import Wallet
+
         wallet = Wallet.all()
         if not wallet:
             return
@@ -116,8 +119,11 @@ def main():
         print('#', ':: | Credit Sum        :: {} Kč '.format(wallet[0].creditSum))
         print('#', ':' * 79)
 
+        logging.getLogger('zonkylla').debug('Identity map: %s', IdentityMap().stats)
+
     if args['interactive']:
         import IPython
+        from .core import models  # pylint: disable=unused-import
         IPython.embed()
 
 
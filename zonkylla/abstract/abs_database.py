@@ -6,21 +6,63 @@
 '''Database module'''
 
 import os
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import datetime
+from functools import partial
+from itertools import islice
+from operator import itemgetter
 import logging
 from pathlib import Path
 import sqlite3
 import sys
+from time import time
 import yaml
 
 from zonkylla.core.config import Config
+from zonkylla.abstract.migrations import MIGRATIONS, MIN_MIGRATABLE_VERSION
 from zonkylla.abstract.singleton_meta import Singleton
 from zonkylla.core.utils import iso2datetime
 
-DB_VERSION = 3
+DB_VERSION = 6
+INSERT_CHUNK_SIZE = 1000
+FETCH_BATCH_SIZE = 1000
+# longer lists of values are matched through temporary table
+MAX_IN_VALUES = 256
+REBUILD_CHUNK_SIZE = 50000
 
 
-class Database(metaclass=Singleton):
+def convert_bool(value):
+    '''Convert bool to int'''
+
+    if value is True or value is False:
+        return int(value)
+
+    if 'true' in str(value).lower():
+        value = 1
+    elif 'false' in str(value).lower():
+        value = 0
+    elif int(value) == 1:
+        value = 1
+    elif int(value) == 0:
+        value = 0
+
+    return value
+
+
+VALUE_CONVERTERS = {
+    'text': str,
+    'int': int,
+    'real': float,
+    'bool': convert_bool,
+    'datetime': (lambda v: v),
+}
+
+
+ValuesTable = namedtuple('ValuesTable', ['key'])
+
+
+class Database(metaclass=Singleton):  # pylint: disable=too-many-instance-attributes
     '''Connection with sqlite3 database'''
 
     def __init__(self):
@@ -33,6 +75,12 @@ class Database(metaclass=Singleton):
         self._last_update = None
         self._db_file = ''
         self._db_exists = None
+        self._row_converters = {}
+        self._statements = OrderedDict()
+        self._statement_hits = 0
+        self._statement_misses = 0
+        self._bulk_stats = None
+        self._uncommitted_rows = 0
         self.can_be_empty = True
 
     @property
@@ -41,16 +89,43 @@ class Database(metaclass=Singleton):
         if not self._schema:
             schema_file = os.path.join(sys.prefix, 'zonkylla', 'data', 'tables.yaml')
             with open(schema_file, 'r') as stream:
-                self._schema = yaml.load(stream)
+                self._schema = yaml.safe_load(stream)
         return self._schema
 
     @property
     def connection(self):
         '''DB connection which is established when needed'''
         if not self._connection:
-            self._connection = sqlite3.connect(self.db_file)
+            self._connection = sqlite3.connect(
+                self.db_file, cached_statements=Config().cached_statements)
+            # rows are tuples with access by column names built in C
+            self._connection.row_factory = sqlite3.Row
         return self._connection
 
+    @property
+    def statement_stats(self):
+        '''Counters of prepared statements reused from connection's cache
+
+        The cache of sqlite3 module isn't observable, so its LRU policy
+        is replayed over executed SQL commands.
+        '''
+        return {
+            'cached_statements': Config().cached_statements,
+            'hits': self._statement_hits,
+            'misses': self._statement_misses,
+        }
+
+    def _track_statement(self, sql):
+        if sql in self._statements:
+            self._statements.move_to_end(sql)
+            self._statement_hits += 1
+            return
+
+        self._statement_misses += 1
+        self._statements[sql] = None
+        if len(self._statements) > Config().cached_statements:
+            self._statements.popitem(last=False)
+
     @property
     def db_file(self):
         '''DB file'''
@@ -96,57 +171,143 @@ class Database(metaclass=Singleton):
                 self.db_file)
             sys.exit(1)
 
-        if not res['mdb_version']:
+        db_version = res['mdb_version']
+        if not db_version:
             sql = 'INSERT INTO z_internals (db_version) VALUES (?)'
             self.execute(sql, [(DB_VERSION)])
-            return
 
-        if res['mdb_version'] != DB_VERSION:
+        elif db_version > DB_VERSION:
+            self.logger.error(
+                "Newer version of database schema (%s), upgrade zonkylla, please.",
+                db_version)
+            sys.exit(1)
+
+        elif db_version < MIN_MIGRATABLE_VERSION:
             self.logger.error(
                 "Old version of database schema, remove file '%s', please.",
                 self.db_file)
             sys.exit(1)
 
-    def _convert_value(self, table, key, value):
-        '''Convert value due to database schema'''
+        elif db_version < DB_VERSION:
+            self.migrate(db_version)
 
-        def convert_bool(value):
-            '''Convert bool to str'''
+        # indexes added to schema later are created in existing database
+        self.create_indexes()
 
-            if 'true' in str(value).lower():
-                value = 1
-            elif 'false' in str(value).lower():
-                value = 0
-            elif int(value) == 1:
-                value = 1
-            elif int(value) == 0:
-                value = 0
+    def migrate(self, db_version):
+        '''Migrate database from given version of schema to the current one
 
-            return value
-            # end of function
+        Explicit steps of all versions are run and then the structure is
+        synchronized with schema, everything within one transaction.
+        '''
 
-        if value is None:
-            return None
+        self.logger.info('Migrating database schema from version %s to %s',
+                         db_version, DB_VERSION)
 
-        value_type = self.schema[table]['columns'][key]
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute('BEGIN')
+        try:
+            for version in range(db_version + 1, DB_VERSION + 1):
+                for step in MIGRATIONS.get(version, []):
+                    self.logger.debug('Migration step to version %s: %s', version, step)
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
 
-        value_convertion = {
-            'text': str,
-            'int': int,
-            'real': float,
-            'bool': convert_bool,
-            'datetime': (lambda v: v),
-        }
+            for table in self.schema:
+                self._migrate_table(cursor, table)
 
-        try:
-            return value_convertion[value_type](value)
-        except BaseException:
-            raise TypeError(table, key, value)
+            cursor.execute('INSERT INTO z_internals (db_version) VALUES (?)', [DB_VERSION])
+        except sqlite3.Error as err:
+            self.connection.rollback()
+            self.logger.error('Migration of database schema failed: %s', err)
+            sys.exit(1)
+
+        self.connection.commit()
+        print('Database schema was migrated from version {} to {}.'.format(
+            db_version, DB_VERSION))
+
+    def _column_sql_types(self, table):
+        '''SQL types of columns of table by schema'''
+
+        sql_types = OrderedDict()
+        for column_name, column_type in self.schema[table]['columns'].items():
+            if self.schema[table]['primary_key']['name'] == column_name:
+                sql_types[column_name] = 'INTEGER'
+            elif column_type == 'bool':
+                sql_types[column_name] = 'INT'
+            else:
+                sql_types[column_name] = column_type.upper()
+        return sql_types
+
+    def _migrate_table(self, cursor, table):
+        '''Synchronize structure of table with schema
+
+        Missing table is created, missing columns are added and table
+        with changed or removed columns is rebuilt.
+        '''
+
+        existing = OrderedDict(
+            (row[1], (row[2].upper(), bool(row[5])))
+            for row in cursor.execute('PRAGMA table_info({})'.format(table)).fetchall())
+
+        if not existing:
+            self.logger.info("Creating table '%s'", table)
+            cursor.execute(self._create_sql_cmd(table))
+            return
+
+        primary_key = self.schema[table]['primary_key']['name']
+        expected = self._column_sql_types(table)
+
+        changed = [column for column, (sql_type, is_pk) in existing.items()
+                   if expected.get(column) != sql_type or is_pk != (column == primary_key)]
+        if changed or primary_key not in existing:
+            self._rebuild_table(cursor, table, [column for column in existing
+                                                if column in expected])
+            return
 
-    def _create_sql_cmd(self, table):
-        '''Return create SQL command'''
+        for column, sql_type in expected.items():
+            if column not in existing:
+                self.logger.info("Adding column '%s.%s'", table, column)
+                cursor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, sql_type))
 
-        cmd = 'CREATE TABLE IF NOT EXISTS {} (\n'.format(table)
+    def _rebuild_table(self, cursor, table, columns):
+        '''Rebuild table by schema keeping data of given columns
+
+        Rows are copied in chunks by rowid, indexes are created again
+        after the migration.
+        '''
+
+        self.logger.info("Rebuilding table '%s'", table)
+
+        new_table = '{}_migration'.format(table)
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(new_table))
+        cursor.execute(self._create_sql_cmd(table, new_table))
+
+        sql = '''
+            INSERT INTO {new_table} ({columns})
+            SELECT {columns} FROM {table}
+            WHERE rowid > ? AND rowid <= ?
+        '''.format(new_table=new_table, table=table, columns=', '.join(columns))
+
+        min_rowid, max_rowid = cursor.execute(
+            'SELECT MIN(rowid), MAX(rowid) FROM {}'.format(table)).fetchone()
+        if min_rowid is not None:
+            for start in range(min_rowid - 1, max_rowid, REBUILD_CHUNK_SIZE):
+                cursor.execute(sql, [start, start + REBUILD_CHUNK_SIZE])
+                self.logger.debug("Copied rows of '%s' up to rowid %d",
+                                  table, start + REBUILD_CHUNK_SIZE)
+
+        cursor.execute('DROP TABLE {}'.format(table))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(new_table, table))
+
+    def _create_sql_cmd(self, table, name=None):
+        '''Return create SQL command (of table with other name if given)'''
+
+        cmd = 'CREATE TABLE IF NOT EXISTS {} (\n'.format(name or table)
         items = []
 
         pk_col_type = 'INTEGER PRIMARY KEY {}'.format(
@@ -170,6 +331,34 @@ class Database(metaclass=Singleton):
 
         return cmd
 
+    def _create_index_sql_cmds(self, table):
+        '''Return dict of create SQL commands of indexes of table by their names'''
+
+        commands = {}
+        for name, index in self.schema[table].get('indexes', {}).items():
+            cmd = 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                'UNIQUE ' if index.get('unique') else '',
+                name,
+                table,
+                ', '.join(index['columns']))
+            if index.get('where'):
+                cmd += ' WHERE {}'.format(index['where'])
+            commands[name] = cmd
+
+        return commands
+
+    def create_indexes(self):
+        '''Create indexes from schema which are missing in database'''
+
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index'"
+        existing = set(row['name'] for row in self.execute(sql).fetchall())
+
+        for table in self.schema:
+            for name, sql_command in self._create_index_sql_cmds(table).items():
+                if name not in existing:
+                    self.logger.info("Creating index '%s'", name)
+                    self.execute(sql_command)
+
     def create(self):
         '''Prepare the structure'''
 
@@ -180,6 +369,8 @@ class Database(metaclass=Singleton):
         for sql_command in sql_commands:
             self.execute(sql_command)
 
+        self.create_indexes()
+
         sql = 'INSERT INTO z_internals (db_version) VALUES (?)'
         self.execute(sql, [(DB_VERSION)])
 
@@ -191,22 +382,15 @@ class Database(metaclass=Singleton):
         sql_command = 'DELETE FROM {}'.format(table)
         self.execute(sql_command)
 
-    def mark_update(self):
-        '''Mark that databse was updated'''
+    def mark_update(self, updated=None):
+        '''Mark that databse was updated (at given time, now by default)'''
         sql = 'INSERT INTO z_internals (updated) VALUES (?)'
-        self.execute(sql, [(datetime.datetime.now())])
+        self.execute(sql, [(updated or datetime.datetime.now())])
+        self._last_update = None
 
     def execute(self, sql, data=None):
         """Executes SQL query with or without data"""
 
-        def dict_factory(cursor, row):
-            '''Dictionary factory for row_factory'''
-            result = {}
-            for idx, col in enumerate(cursor.description):
-                result[col[0]] = row[idx]
-            return result
-        # end of function
-
         if data is None:
             many = False
         elif isinstance(data, list):
@@ -215,20 +399,30 @@ class Database(metaclass=Singleton):
         else:
             raise TypeError
 
+        def run(con):
+            '''Run the query on cursor of given connection'''
+            con = con.cursor()
+            self.logger.debug("Executing '%s'", sql)
+            self._track_statement(sql)
+            if many:
+                self.logger.debug("with many data: '%s'", data)
+                return con.executemany(sql, data)
+            if data:
+                self.logger.debug("with data: '%s'", data)
+                return con.execute(sql, data)
+            return con.execute(sql)
+        # end of function
+
         try:
-            with self.connection as con:
-                con.row_factory = dict_factory
-                con = con.cursor()
-                self.logger.debug("Executing '%s'", sql)
-                if many:
-                    self.logger.debug("with many data: '%s'", data)
-                    result = con.executemany(sql, data)
-                else:
-                    if data:
-                        self.logger.debug("with data: '%s'", data)
-                        result = con.execute(sql, data)
-                    else:
-                        result = con.execute(sql)
+            if self._bulk_stats is None:
+                with self.connection as con:
+                    result = run(con)
+            else:
+                result = run(self.connection)
+                self._uncommitted_rows += max(result.rowcount, 0)
+                if self._uncommitted_rows >= Config().bulk_commit_rows > 0:
+                    self.connection.commit()
+                    self._uncommitted_rows = 0
             return result
 
         except sqlite3.Error as err:
@@ -236,35 +430,118 @@ class Database(metaclass=Singleton):
             raise
 
     def insert_or_update(self, table, data):
-        '''Common insert or update query'''
+        '''Common insert or update query
 
-        if not data:
-            return
+        Data could be any iterable of rows, it is consumed and written
+        in chunks, so it doesn't need to be held in memory at once.
+        '''
+
+        data = iter(data)
+        while True:
+            chunk = list(islice(data, INSERT_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            started = time()
+            self._insert_or_update_chunk(table, chunk)
+
+            if self._bulk_stats is not None:
+                rows, seconds = self._bulk_stats.get(table, (0, 0.0))
+                self._bulk_stats[table] = (rows + len(chunk), seconds + time() - started)
+
+    @contextmanager
+    def bulk_ingest(self):
+        '''Write everything within the block in big transactions
+
+        Pragmas from the [bulk_ingest] section of configuration are set
+        and changes are committed after every 'commit_rows' rows and at
+        the end of the block (also when it fails, so progress isn't lost).
+
+        It yields dict with number of written rows and seconds spent
+        by writing for every table.
+        '''
+
+        for pragma, value in Config().bulk_pragmas.items():
+            sql = 'PRAGMA {} = {}'.format(pragma, value)
+            self.logger.debug("Executing '%s'", sql)
+            self.connection.execute(sql)
+
+        self._bulk_stats = {}
+        self._uncommitted_rows = 0
+        try:
+            yield self._bulk_stats
+        finally:
+            self.connection.commit()
+            self._bulk_stats = None
 
-        rows = []
-        for dat in data:
-            row = []
-            cols = []
-
-            for key, value in dat.items():
-                # whitelisting only columns in schema
-                if key not in self.schema[table]['columns'].keys():
-                    self.logger.warning(
-                        "'%s.%s' with value '%s' present in API response but not in DB schema",
-                        table,
-                        key,
-                        value)
-                    continue
-                cols.append(key)
-                row.append(self._convert_value(table, key, value))
-
-            rows.append((row))
-            columns = ', '.join(cols)
-            placeholders = ', '.join('?' * len(cols))
+    def _row_converter(self, table, keys):
+        '''Compiled converter of rows of table with given keys
+
+        It's built once for every table and key set.
+
+        :return:  tuple of INSERT SQL command and function converting
+                  row (dict) to tuple of values in order of the command
+        '''
+
+        converter = self._row_converters.get((table, keys))
+        if converter is not None:
+            return converter
+
+        schema_columns = self.schema[table]['columns']
+
+        # whitelisting only columns in schema
+        for key in sorted(keys - schema_columns.keys()):
+            self.logger.warning(
+                "'%s.%s' present in API response but not in DB schema", table, key)
+
+        columns = [column for column in schema_columns if column in keys]
+        converters = [VALUE_CONVERTERS[schema_columns[column]] for column in columns]
+        if len(columns) > 1:
+            get_values = itemgetter(*columns)
+        else:
+            def get_values(row):
+                '''Tuple of one value, itemgetter of one item doesn't return tuple'''
+                return tuple(row[column] for column in columns)
+
+        def convert(row):
+            '''Convert row to tuple of values'''
+            try:
+                return tuple([None if value is None else convert_value(value)
+                              for convert_value, value in zip(converters, get_values(row))])
+            except BaseException:
+                for column, convert_value in zip(columns, converters):
+                    try:
+                        if row[column] is not None:
+                            convert_value(row[column])
+                    except BaseException:
+                        raise TypeError(table, column, row[column])
+                raise
 
         sql = 'INSERT OR REPLACE INTO {}({}) VALUES ({})'.format(
-            table, columns, placeholders)
-        self.execute(sql, rows)
+            table, ', '.join(columns), ', '.join('?' * len(columns)))
+
+        converter = (sql, convert)
+        self._row_converters[(table, keys)] = converter
+        return converter
+
+    def _insert_or_update_chunk(self, table, data):
+        '''Insert or update of list of rows
+
+        Rows are grouped by their keys, every group is written by one
+        executemany command.
+        '''
+
+        batches = OrderedDict()
+        for row in data:
+            keys = frozenset(row)
+            if keys not in batches:
+                batches[keys] = (self._row_converter(table, keys), [])
+            (_, convert), rows = batches[keys]
+            rows.append(convert(row))
+
+        for (sql, _), rows in batches.values():
+            if rows[0]:
+                self.execute(sql, rows)
 
     def get_one(self, table, record_id):
         '''Returns data from one row of a table'''
@@ -272,21 +549,136 @@ class Database(metaclass=Singleton):
         self._check_if_can_be_empty()
 
         select_sql = '*'
-        sql = 'SELECT {} FROM {} WHERE id == {}'.format(
-            select_sql, table, record_id)
-        return self.execute(sql).fetchone()
+        sql = 'SELECT {} FROM {} WHERE id = ?'.format(select_sql, table)
+        return self.execute(sql, [record_id]).fetchone()
 
     def get_all(self, table, record_ids=None):
         '''Returns multiple data from multiple rows of a table'''
 
+        conditions = {'id': record_ids} if isinstance(record_ids, list) else None
+        return list(self.select(table, conditions=conditions))
+
+    def get_columns(self, table, columns=None, record_ids=None):
+        '''Returns data of a table as lists of values by columns'''
+
         self._check_if_can_be_empty()
 
-        select_sql = '*'
-        if isinstance(record_ids, list):
-            record_ids_sql = 'WHERE id IN (' + ', '.join(
-                [str(record_id) for record_id in record_ids]) + ')'
-        else:
-            record_ids_sql = ''
+        conditions = {'id': record_ids} if isinstance(record_ids, list) else None
+        with self._bound_values(conditions) as bound:
+            sql, data = self._select_sql(table, columns, bound)
+            return self.fetch_columns(sql, data)
+
+    def fetch_columns(self, sql, data=None):
+        '''Executes SQL query and returns OrderedDict of lists of values by columns'''
+
+        cursor = self.connection.cursor()
+        # plain tuples are enough for transposition
+        cursor.row_factory = None
+        self.logger.debug("Executing '%s'", sql)
+        self._track_statement(sql)
+        cursor.execute(sql, data or [])
+
+        names = [description[0] for description in cursor.description]
+        values = list(zip(*cursor.fetchall())) or [()] * len(names)
+        return OrderedDict((name, list(column)) for name, column in zip(names, values))
+
+    @staticmethod
+    def _select_sql(table, columns=None, conditions=None, order_by=None, limit=None):
+        '''Return SELECT SQL command and its data
+
+        :param table:       name of table or join of tables, columns of
+                            join are qualified by names of tables
+        :param columns:     names of selected columns, all by default
+        :param conditions:  dict of column names and values, list, tuple or
+                            set of values is matched by IN, None by IS NULL,
+                            ValuesTable by IN of its values in z_values
+        :param order_by:    names of columns, prefixed by '-' for DESC order
+        :param limit:       maximal number of rows
+        '''
+
+        sql = 'SELECT {} FROM {}'.format(', '.join(columns) if columns else '*', table)
+        data = []
+
+        where = []
+        for column, value in (conditions or {}).items():
+            if value is None:
+                where.append('{} IS NULL'.format(column))
+            elif isinstance(value, ValuesTable):
+                where.append('{} IN (SELECT value FROM temp.z_values WHERE key = ?)'.format(
+                    column))
+                data.append(value.key)
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                value = list(value)
+                # lists are padded to powers of two by repeating the last
+                # value, so commands are reused from statement cache
+                if value:
+                    value += value[-1:] * ((1 << (len(value) - 1).bit_length()) - len(value))
+                where.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+                data.extend(value)
+            else:
+                where.append('{} = ?'.format(column))
+                data.append(value)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        if order_by:
+            sql += ' ORDER BY ' + ', '.join(
+                '{} DESC'.format(column[1:]) if column.startswith('-') else column
+                for column in order_by)
+
+        if limit is not None:
+            sql += ' LIMIT ?'
+            data.append(int(limit))
+
+        return sql, data
+
+    def select(self, table, columns=None, conditions=None, order_by=None, limit=None):
+        '''Generator of rows of a table, see _select_sql for parameters
+
+        Rows are fetched from cursor in batches, so whole result
+        doesn't need to be held in memory at once. Results of conditions
+        with long lists of values are fetched whole, because the values
+        are cleared from temporary table when the query is done.
+        '''
 
-        sql = 'SELECT {} FROM {} {}'.format(select_sql, table, record_ids_sql)
-        return self.execute(sql).fetchall()
+        self._check_if_can_be_empty()
+
+        with self._bound_values(conditions) as bound:
+            sql, data = self._select_sql(table, columns, bound, order_by, limit)
+            cursor = self.execute(sql, data or None)
+            if bound is conditions:
+                batches = iter(partial(cursor.fetchmany, FETCH_BATCH_SIZE), [])
+            else:
+                batches = [cursor.fetchall()]
+
+        for rows in batches:
+            yield from rows
+
+    @contextmanager
+    def _bound_values(self, conditions):
+        '''Conditions with long lists of values moved to temporary table
+
+        All lists are kept in one table z_values under keys of their
+        conditions, so the same commands are reused from statement cache.
+        The table is cleared when the block is left. Conditions are
+        returned as they are if no list is long.
+        '''
+
+        long_lists = [column for column, values in (conditions or {}).items()
+                      if isinstance(values, (list, tuple, set, frozenset))
+                      and len(values) > MAX_IN_VALUES]
+        if not long_lists:
+            yield conditions
+            return
+
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS z_values (key INTEGER, value)')
+        bound = OrderedDict(conditions)
+        for key, column in enumerate(long_lists):
+            self.execute('INSERT INTO temp.z_values VALUES (?, ?)',
+                         [(key, value) for value in conditions[column]])
+            bound[column] = ValuesTable(key)
+
+        try:
+            yield bound
+        finally:
+            self.execute('DELETE FROM temp.z_values')
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Database migrations module
+
+Every schema version which changes data (not only structure) has its
+list of explicit steps here. A step is SQL command or function taking
+cursor, it's run before the structure is synchronized with tables.yaml,
+so it sees tables of the previous version. Added tables, columns and
+indexes, and changed types or primary keys are handled by the schema
+diff and don't need any step.
+'''
+
+# the oldest version of schema which can be migrated
+MIN_MIGRATABLE_VERSION = 3
+
+# explicit steps by version which they lead to
+MIGRATIONS = {
+    # z_checkpoints table
+    4: [],
+    # z_loans_sync table
+    5: [],
+    # z_projected_payments and z_projected_investments tables, they are
+    # filled by the next update
+    6: [],
+}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Asyncio Zonky clients module'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import logging
+
+from .config import Config
+from .zonky import CHECKPOINT_CHUNK_SIZE, Client, OAuthClient, Zonky
+
+
+async def run_in_executor(executor, func, *args):
+    """Run blocking function in the executor"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(func, *args))
+
+
+class AsyncClientMixin:
+    """Asyncio interface for Zonky clients
+
+    Blocking requests are sent from the executor, so independent pages
+    and endpoints are downloaded concurrently while the rate limiter
+    shared by all clients keeps the pace of requests.
+    """
+
+    _executor = None
+
+    async def _request(self, method, url, params=None, headers=None):
+        """Method for sending of request to Zonky
+
+        All pages following the first one are requested at once.
+
+        :param method:  GET, POST, PATCH, DELETE
+        :param url:     url as tuple without base
+        :return:        json with result
+        """
+
+        if params is None:
+            params = {}
+        headers = self._prepare_headers(url, headers)
+
+        result, response_headers = await run_in_executor(
+            self._executor, self._request_first_page, method, url, params, headers)
+
+        pages = self._following_pages(headers, response_headers)
+        if pages:
+            following = await asyncio.gather(*[
+                run_in_executor(self._executor, self._request_page, method, url, params,
+                                dict(headers, **{'X-Page': str(page)}))
+                for page in pages])
+            result = result + list(chain.from_iterable(
+                page_result for page_result, _ in following))
+
+        return result
+
+    async def get(self, url, params=None, headers=None):
+        """GET Method"""
+        return await self._request('GET', url, params, headers)
+
+    async def post(self, url, params=None, headers=None):
+        """POST Method"""
+        return await self._request('POST', url, params, headers)
+
+    async def patch(self, url, params=None, headers=None):
+        """PATCH Method"""
+        return await self._request('PATCH', url, params, headers)
+
+    async def delete(self, url, params=None, headers=None):
+        """DELETE Method"""
+        return await self._request('DELETE', url, params, headers)
+
+
+class AsyncOAuthClient(AsyncClientMixin, OAuthClient):
+    """Asyncio OAuth Client for Zonky"""
+
+    def __init__(self, host, username, password, executor=None):
+        """Asyncio OAuth Client
+        :param host: URL of Zonky
+        :param username: Username of Zonky user
+        :param password: Password of Zonky user
+        :param executor: Executor used for blocking requests
+        """
+
+        OAuthClient.__init__(self, host, username, password)
+        self._executor = executor
+        self.logger = logging.getLogger('zonkylla.AsyncOAuthClient')
+
+
+class AsyncClient(AsyncClientMixin, Client):
+    """Asyncio Client for Zonky"""
+
+    def __init__(self, host, executor=None):
+        """
+
+        :param host:  URL of Zonky
+        :param executor: Executor used for blocking requests
+        """
+
+        Client.__init__(self, host)
+        self._executor = executor
+        self.logger = logging.getLogger('zonkylla.AsyncClient')
+
+
+class AsyncZonky(Zonky):
+    """Asyncio interface to zonky API
+
+    All download methods of Zonky return awaitables here (iter_* methods
+    still return blocking generators of pages), update of database is
+    awaitable update_async. It shares checkpoints with Zonky.update, so
+    an update interrupted by one of them is resumed by the other.
+    """
+
+    def __init__(self, host, username=None, password=None, workers=None):
+        """Asyncio interface to zonky API
+
+        :param host:
+        :param username:
+        :param password:
+        :param workers:  number of concurrent requests, 'async_workers'
+                         of configuration by default
+        """
+
+        if workers is None:
+            workers = Config().async_workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        Zonky.__init__(self, host, username, password, workers)
+
+    def _new_client(self, host):
+        return AsyncClient(host, self._executor)
+
+    def _new_oauth_client(self, host, username, password):
+        return AsyncOAuthClient(host, username, password, self._executor)
+
+    def update(self, database):
+        '''Update all data for user from zonky, blocks until it's done'''
+        asyncio.get_event_loop().run_until_complete(self.update_async(database))
+
+    async def update_async(self, database):
+        '''Update all data for user from zonky'''
+
+        with database.bulk_ingest() as stats:
+            await self._update_async(database)
+        self._print_update_stats(database, stats)
+
+    async def _update_pages_async(self, database, stage, iter_pages, insert):
+        '''Insert pages into database and save the progress of stage
+
+        Pages are downloaded in the executor, so stages run concurrently,
+        while database is written only from the event loop.
+        '''
+
+        values = database.checkpoint(stage)
+        offset = int(values[-1]) if values else 0
+
+        pages = iter_pages(offset)
+        while True:
+            page = await run_in_executor(self._executor, next, pages, None)
+            if page is None:
+                break
+            insert(page)
+            offset += len(page)
+            database.set_checkpoint(stage, offset)
+        database.add_checkpoint('done', [stage])
+
+    async def _update_per_loan_async(self, database, stage, func, insert):
+        '''Download data of pending loans and save the progress of stage'''
+
+        loan_ids = self._pending_loan_ids(database, stage)
+
+        for start in range(0, len(loan_ids), CHECKPOINT_CHUNK_SIZE):
+            chunk = loan_ids[start:start + CHECKPOINT_CHUNK_SIZE]
+            insert(await asyncio.gather(*[func(loan_id) for loan_id in chunk]))
+            database.add_checkpoint(stage, chunk)
+        database.add_checkpoint('done', [stage])
+
+    async def _update_async(self, database):
+        '''Update all data within bulk ingest, see Zonky.update'''
+
+        last_dt, started, done = self._begin_update(database)
+
+        print('# Download wallet, blocked amounts and user notifications')
+        wallet, blocked_amounts, notifications = await asyncio.gather(
+            self.get_wallet(),
+            self.get_blocked_amounts(),
+            self.get_user_notifications())
+
+        database.insert_wallet([wallet])
+        database.insert_blocked_amounts(blocked_amounts)
+        database.insert_user_notifications(notifications)
+
+        print('# Calculate notification relations')
+        database.update_user_notifications_relations()
+
+        print('# Update transactions and user investments')
+        stages = []
+        if 'transactions' not in done:
+            stages.append(self._update_pages_async(
+                database, 'transactions',
+                lambda offset: self.iter_transactions(from_dt=last_dt, offset=offset),
+                lambda transactions: self._insert_transactions(database, transactions)))
+        for time_type in ('created', 'modified'):
+            stage = 'user_investments_{}'.format(time_type)
+            if stage in done:
+                continue
+            stages.append(self._update_pages_async(
+                database, stage,
+                lambda offset, time_type=time_type: self.iter_user_investments(
+                    time_type=time_type, from_dt=last_dt, offset=offset),
+                database.insert_user_investments))
+        await asyncio.gather(*stages)
+
+        if 'loans' not in done:
+            self._skip_complete_loans(database)
+
+        print('# Download missing loans and loan investments')
+        stages = []
+        if 'loans' not in done:
+            stages.append(self._update_per_loan_async(
+                database, 'loans', self.get_loan, database.insert_loans))
+        if 'loan_investments' not in done:
+            stages.append(self._update_per_loan_async(
+                database, 'loan_investments', self.get_loan_investments,
+                lambda investments: database.insert_loan_investments(
+                    chain.from_iterable(investments))))
+        await asyncio.gather(*stages)
+
+        self._finish_update(database, started)
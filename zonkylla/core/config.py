@@ -12,6 +12,28 @@ import sys
 
 from zonkylla.abstract.singleton_meta import Singleton
 
+DEFAULT_WORKERS = 1
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 1
+DEFAULT_PREFETCH = 1
+MIN_ASYNC_WORKERS = 4
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MIN_PAGE_SIZE = 10
+DEFAULT_HTTP_CACHE_MAX_ENTRIES = 100000
+DEFAULT_LOAN_MAX_AGE = 30
+DEFAULT_BULK_COMMIT_ROWS = 50000
+DEFAULT_CACHED_STATEMENTS = 256
+DEFAULT_IDENTITY_MAP_SIZE = 10000
+DEFAULT_BULK_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': '-65536',
+    'mmap_size': '268435456',
+}
+
 
 class Config(metaclass=Singleton):
     '''Configuration class'''
@@ -44,3 +66,117 @@ class Config(metaclass=Singleton):
     def db_file(self):
         '''Database file'''
         return self._db_file
+
+    @property
+    def cached_statements(self):
+        '''Number of prepared SQL statements kept by database connection'''
+        return self.config.getint(
+            'zonkylla', 'cached_statements', fallback=DEFAULT_CACHED_STATEMENTS)
+
+    @property
+    def identity_map_size(self):
+        '''Number of models kept in memory after lookup by ID, 0 disables it'''
+        return self.config.getint(
+            'zonkylla', 'identity_map_size', fallback=DEFAULT_IDENTITY_MAP_SIZE)
+
+    @property
+    def workers(self):
+        '''Number of concurrent workers used for per-loan downloads'''
+        return self.config.getint('zonky', 'workers', fallback=DEFAULT_WORKERS)
+
+    @property
+    def rate(self):
+        '''Maximal number of requests per second sent to Zonky'''
+        return self.config.getfloat('zonky', 'rate', fallback=DEFAULT_RATE)
+
+    @property
+    def burst(self):
+        '''Number of requests which can be sent to Zonky at once'''
+        return self.config.getint('zonky', 'burst', fallback=DEFAULT_BURST)
+
+    @property
+    def async_workers(self):
+        '''Number of threads sending requests of asynchronous update
+
+        By default it's enough to overlap downloads of independent
+        endpoints, the rate limiter keeps the pace of requests anyway.
+        '''
+        return self.config.getint(
+            'zonky', 'async_workers',
+            fallback=max(self.workers, self.prefetch, MIN_ASYNC_WORKERS))
+
+    @property
+    def prefetch(self):
+        '''Number of pages of one response requested concurrently'''
+        return self.config.getint('zonky', 'prefetch', fallback=DEFAULT_PREFETCH)
+
+    @property
+    def retries(self):
+        '''Number of retries of request failed due to transient error'''
+        return self.config.getint('zonky', 'retries', fallback=DEFAULT_RETRIES)
+
+    @property
+    def backoff(self):
+        '''Base of exponential backoff between retries in seconds'''
+        return self.config.getfloat('zonky', 'backoff', fallback=DEFAULT_BACKOFF)
+
+    @property
+    def loan_max_age(self):
+        '''Days after which complete loan is downloaded again'''
+        return self.config.getint('zonky', 'loan_max_age', fallback=DEFAULT_LOAN_MAX_AGE)
+
+    @property
+    def pool_size(self):
+        '''Maximal number of kept-alive connections to Zonky'''
+        return self.config.getint('zonky', 'pool_size', fallback=DEFAULT_POOL_SIZE)
+
+    @property
+    def compression(self):
+        '''Boolean if compressed responses are accepted'''
+        return self.config.getboolean('zonky', 'compression', fallback=True)
+
+    def page_size(self, endpoint):
+        '''Initial page size for given endpoint'''
+        default = self.config.getint('page_size', 'default', fallback=DEFAULT_PAGE_SIZE)
+        return self.config.getint('page_size', endpoint, fallback=default)
+
+    @property
+    def min_page_size(self):
+        '''Page size which is not lowered anymore'''
+        return self.config.getint('page_size', 'minimum', fallback=DEFAULT_MIN_PAGE_SIZE)
+
+    @property
+    def http_cache_file(self):
+        '''File of HTTP cache, the cache is disabled when it's not set'''
+        return self.config.get('http_cache', 'file', fallback=None)
+
+    @property
+    def http_cache_max_entries(self):
+        '''Maximal number of responses kept in HTTP cache'''
+        return self.config.getint(
+            'http_cache', 'max_entries', fallback=DEFAULT_HTTP_CACHE_MAX_ENTRIES)
+
+    def http_cache_ttl(self, endpoint):
+        '''Seconds for which cached response of endpoint is fresh
+
+        None means that the endpoint is not cached.
+        '''
+        return self.config.getint('http_cache', endpoint, fallback=None)
+
+    @property
+    def bulk_commit_rows(self):
+        '''Number of rows written by bulk ingest within one transaction
+
+        Zero means that everything is written in one transaction.
+        '''
+        return self.config.getint(
+            'bulk_ingest', 'commit_rows', fallback=DEFAULT_BULK_COMMIT_ROWS)
+
+    @property
+    def bulk_pragmas(self):
+        '''SQLite pragmas set for bulk ingest'''
+        pragmas = dict(DEFAULT_BULK_PRAGMAS)
+        if self.config.has_section('bulk_ingest'):
+            pragmas.update(self.config.items('bulk_ingest'))
+        pragmas.pop('commit_rows', None)
+        return pragmas
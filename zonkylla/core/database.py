@@ -7,10 +7,88 @@
 
 from abc import ABCMeta
 import ast
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import sys
 import logging
 
 from zonkylla.abstract.abs_database import Database
+from zonkylla.abstract.singleton_meta import Singleton
+from zonkylla.core.config import Config
+from zonkylla.core.payment_plan import PaymentPlan
+from zonkylla.core.utils import iso2datetime
+
+# columns of user investments which change their projected payments
+PROJECTED_INVESTMENT_COLUMNS = (
+    'remainingPrincipal', 'remainingMonths', 'nextPaymentDate', 'paymentStatus')
+
+
+class IdentityMap(metaclass=Singleton):
+    '''Models loaded by their IDs kept in memory
+
+    Repeated lookups of the same record return the same object without
+    query. The least recently used models are evicted when there are
+    more than 'identity_map_size' of them, models of a table are
+    forgotten whenever the table is written.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger('zonkylla.core.IdentityMap')
+
+        # models are imported before configuration is read
+        self._size = None
+        self._models = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        '''Counters of lookups'''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._models),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def get(self, table, record_id):
+        '''Model of the record or None if it isn't kept'''
+
+        model = self._models.get((table, record_id))
+        if model is None:
+            self.misses += 1
+            return None
+
+        self._models.move_to_end((table, record_id))
+        self.hits += 1
+        return model
+
+    def put(self, table, record_id, model):
+        '''Keep model of the record'''
+
+        if self._size is None:
+            self._size = Config().identity_map_size
+        if self._size <= 0:
+            return
+
+        self._models[(table, record_id)] = model
+        self._models.move_to_end((table, record_id))
+        while len(self._models) > self._size:
+            self._models.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, table):
+        '''Forget all models of the table'''
+
+        keys = [key for key in self._models if key[0] == table]
+        for key in keys:
+            del self._models[key]
+        if keys:
+            self.logger.debug("Forgot %d models of '%s'", len(keys), table)
 
 
 class DatabaseClient(metaclass=ABCMeta):
@@ -27,6 +105,11 @@ class DatabaseClient(metaclass=ABCMeta):
         '''Last update of database'''
         return self.dbase.last_update
 
+    @property
+    def statement_stats(self):
+        '''Counters of prepared statements reused from cache'''
+        return self.dbase.statement_stats
+
     def check_if_exists(self):
         '''Check if DB exists'''
         return self.dbase.db_exists
@@ -69,45 +152,170 @@ class DBUpdaterClient(DatabaseClient):
                 "Missing database file '%s', run 'zonkylla init', please.",
                 self.dbase.db_file)
             sys.exit(1)
+        # database of older schema is migrated before anything is written
+        self.check_db_version()
 
     def prepare_for_data_update(self):
         '''Prepare DB for data update
            ...it drop some tables if it is necessary
         '''
-        self.dbase.clear_table('a_wallet')
-        self.dbase.clear_table('a_blocked_amounts')
-
-    def mark_update(self):
-        '''Mark that database was updated'''
-        self.dbase.mark_update()
+        for table in ('a_wallet', 'a_blocked_amounts'):
+            IdentityMap().invalidate(table)
+            self.dbase.clear_table(table)
+
+    def _insert(self, table, data):
+        '''Insert or update rows, models of the table kept in memory are forgotten'''
+        IdentityMap().invalidate(table)
+        self.dbase.insert_or_update(table, data)
+
+    def mark_update(self, updated=None):
+        '''Mark that database was updated (at given time, now by default)'''
+        self.dbase.mark_update(updated)
+
+    def bulk_ingest(self):
+        '''Context of bulk writes, see Database.bulk_ingest'''
+        return self.dbase.bulk_ingest()
+
+    def checkpoint(self, stage):
+        '''Values saved by checkpoints of the stage of update'''
+        sql = 'SELECT value FROM z_checkpoints WHERE stage = ? ORDER BY id'
+        return [row['value'] for row in self.dbase.execute(sql, [stage]).fetchall()]
+
+    def add_checkpoint(self, stage, values):
+        '''Save values reached in the stage of update'''
+        self._insert(
+            'z_checkpoints', ({'stage': stage, 'value': value} for value in values))
+
+    def set_checkpoint(self, stage, value):
+        '''Replace values of the stage of update by one value'''
+        self.dbase.execute('DELETE FROM z_checkpoints WHERE stage = ?', [stage])
+        self.add_checkpoint(stage, [value])
+
+    def clear_checkpoints(self):
+        '''Forget all checkpoints, the update is complete'''
+        self.dbase.clear_table('z_checkpoints')
 
     def insert_wallet(self, wallet):
         '''Add user's notifications'''
-        self.dbase.insert_or_update('a_wallet', wallet)
+        self._insert('a_wallet', wallet)
 
     def insert_blocked_amounts(self, blocked_amounts):
         '''Add user's notifications'''
-        self.dbase.insert_or_update('a_blocked_amounts', blocked_amounts)
+        self._insert('a_blocked_amounts', blocked_amounts)
 
     def insert_transactions(self, transactions):
         '''Add transactions to the database'''
-        self.dbase.insert_or_update('a_transactions', transactions)
+        self._insert('a_transactions', transactions)
 
     def insert_loans(self, loans):
-        '''Add loans to the database'''
-        self.dbase.insert_or_update('a_loans', loans)
+        '''Add loans to the database and remember when they were fetched'''
+
+        loan_ids = []
+
+        def remember_ids(loans):
+            for loan in loans:
+                loan_ids.append(loan['id'])
+                yield loan
+
+        self._insert('a_loans', remember_ids(loans))
+
+        fetched = datetime.now()
+        self._insert(
+            'z_loans_sync', ({'loanId': loan_id, 'fetched': fetched} for loan_id in loan_ids))
+
+    def complete_loans(self, loan_ids, max_age):
+        '''IDs of loans which don't need to be fetched again
+
+        Those are loans covered and after deadline which were fetched
+        not before max_age (timedelta).
+        '''
+
+        fetched_after = datetime.now() - max_age
+
+        rows = self.dbase.select(
+            'a_loans JOIN z_loans_sync ON z_loans_sync.loanId = a_loans.id',
+            ['a_loans.id AS id', 'covered', 'deadline', 'fetched'],
+            {'a_loans.id': loan_ids})
+
+        complete_ids = []
+        for row in rows:
+            if not (row['covered'] and row['deadline'] and row['fetched']):
+                continue
+            deadline = iso2datetime(row['deadline'])
+            if deadline < datetime.now(deadline.tzinfo) and \
+                    iso2datetime(row['fetched']) >= fetched_after:
+                complete_ids.append(row['id'])
+
+        self.logger.debug('%d of %d loans are complete', len(complete_ids), len(loan_ids))
+        return complete_ids
 
     def insert_loan_investments(self, investments):
         '''Add investments of loan to the database'''
-        self.dbase.insert_or_update('a_loan_investments', investments)
+        self._insert('a_loan_investments', investments)
 
     def insert_user_investments(self, investments):
         '''Add user's investments to the database'''
-        self.dbase.insert_or_update('a_user_investments', investments)
+        self._insert('a_user_investments', investments)
 
     def insert_user_notifications(self, notifications):
         '''Add user's notifications'''
-        self.dbase.insert_or_update('a_notifications', notifications)
+        self._insert('a_notifications', notifications)
+
+    def update_projected_payments(self):
+        '''Project payments of user investments changed since the last projection
+
+        Payments of investments whose remaining principal, remaining
+        months, next payment date or payment status differ from their
+        values in z_projected_investments are computed again.
+
+        :return:  number of projected investments
+        '''
+
+        sql = '''
+            SELECT ui.id, ui.interestRate, {ui_columns}
+            FROM a_user_investments ui
+            LEFT JOIN z_projected_investments pi ON pi.investmentId = ui.id
+            WHERE pi.investmentId IS NULL OR {changed}
+        '''.format(
+            ui_columns=', '.join('ui.' + column for column in PROJECTED_INVESTMENT_COLUMNS),
+            changed=' OR '.join('pi.{0} IS NOT ui.{0}'.format(column)
+                                for column in PROJECTED_INVESTMENT_COLUMNS))
+        investments = self.dbase.execute(sql).fetchall()
+        if not investments:
+            return 0
+
+        self.dbase.execute('DELETE FROM z_projected_payments WHERE investmentId = ?',
+                           [(investment['id'],) for investment in investments])
+
+        def payments():
+            for investment in investments:
+                if not (investment['remainingPrincipal'] and investment['remainingMonths'] and
+                        investment['nextPaymentDate']):
+                    continue
+
+                plan = PaymentPlan.from_values(
+                    investment['remainingPrincipal'],
+                    investment['interestRate'],
+                    investment['remainingMonths'],
+                    iso2datetime(investment['nextPaymentDate']))
+                for row in plan.iter_payment_calendar():
+                    yield {
+                        'investmentId': investment['id'],
+                        'paymentNumber': row['payment_number'],
+                        'paymentDate': row['payment_date'].isoformat(),
+                        'amount': plan.monthly_payment,
+                        'principal': row['period_to_pay_principal'],
+                        'interest': row['period_to_pay_interest'],
+                    }
+
+        self._insert('z_projected_payments', payments())
+        self._insert('z_projected_investments', (
+            dict({'investmentId': investment['id']},
+                 **{column: investment[column] for column in PROJECTED_INVESTMENT_COLUMNS})
+            for investment in investments))
+
+        self.logger.debug('Payments of %d investments were projected', len(investments))
+        return len(investments)
 
     def missing_user_notifications_relations(self):  # pylint: disable=invalid-name
         '''Get a_notifications.id, link of notifications without relations'''
@@ -161,7 +369,7 @@ class DBUpdaterClient(DatabaseClient):
                                            'foreignId': foreign_id,
                                            'foreignTable': foreign_table})
 
-        self.dbase.insert_or_update(
+        self._insert(
             'z_notifications_relations',
             notification_relations)
 
@@ -172,6 +380,45 @@ class DBModelerClient(DatabaseClient):
     def __init__(self):
         DatabaseClient.__init__(self)
         self.dbase.can_be_empty = False
+        self.identity_map = IdentityMap()
+
+    def select(self, table, columns=None, conditions=None, order_by=None, limit=None):
+        '''Generator of rows of a table, see Database.select'''
+        return self.dbase.select(table, columns, conditions, order_by, limit)
+
+    def monthly_projected_payments(self, since=None, until=None):
+        '''Returns sums of projected payments by months
+
+        :param since:  the first day of payments (date or datetime)
+        :param until:  the last day of payments (date or datetime)
+        :return:       list of rows with month (YYYY-MM), amount,
+                       principal and interest
+        '''
+
+        conditions = []
+        data = []
+        if since is not None:
+            conditions.append('paymentDate >= ?')
+            data.append('{:%Y-%m-%d}'.format(since))
+        if until is not None:
+            conditions.append('paymentDate < ?')
+            data.append('{:%Y-%m-%d}'.format(until + timedelta(days=1)))
+
+        sql = '''
+            SELECT substr(paymentDate, 1, 7) AS month,
+                   SUM(amount) AS amount,
+                   SUM(principal) AS principal,
+                   SUM(interest) AS interest
+            FROM z_projected_payments
+            {}
+            GROUP BY month
+            ORDER BY month
+        '''.format('WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return self.dbase.execute(sql, data or None).fetchall()
+
+    def get_columns(self, table, columns=None):
+        '''Returns data of a table as lists of values by columns'''
+        return self.dbase.get_columns(table, columns)
 
     def get_loans(self, loan_ids=None):
         '''Returns multiple loans data'''
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''HTTP cache module'''
+
+from collections import namedtuple
+import json
+import logging
+import sqlite3
+import threading
+from time import time
+
+from zonkylla.abstract.singleton_meta import Singleton
+from .config import Config
+from .utils import url2endpoint
+
+CacheEntry = namedtuple('CacheEntry', ['result', 'headers', 'validators', 'fresh'])
+
+# request headers which select the content of response
+KEY_HEADERS = ('X-Page', 'X-Size', 'X-Order')
+
+
+class HttpCache(metaclass=Singleton):
+    '''On-disk cache of GET responses from Zonky
+
+    Only endpoints with TTL configured in the [http_cache] section are
+    cached. Fresh responses are served without any request, stale ones
+    are revalidated by ETag or Last-Modified. Responses are kept by host,
+    url, params and paging headers, so responses of one server (e.g. the
+    mock one) are never served for another. The least recently used
+    responses are evicted when there are more than 'max_entries' of them.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger('zonkylla.Core.HttpCache')
+
+        self._cache_file = Config().http_cache_file
+        self._max_entries = Config().http_cache_max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'hits': 0,
+            'revalidations': 0,
+            'misses': 0,
+        }
+
+    @property
+    def connection(self):
+        '''Connection to cache file which is established when needed'''
+        if not self._connection:
+            self._connection = sqlite3.connect(
+                self._cache_file, check_same_thread=False, isolation_level=None)
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    total TEXT,
+                    body BLOB,
+                    stored REAL,
+                    accessed REAL
+                )''')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        return self._connection
+
+    @property
+    def stats(self):
+        '''Counters of cache usage'''
+        with self._lock:
+            return dict(self._stats)
+
+    def _ttl(self, url):
+        '''TTL of responses of the url or None if it isn't cached'''
+        if not self._cache_file:
+            return None
+        return Config().http_cache_ttl(url2endpoint(url))
+
+    @staticmethod
+    def _key(host, url, params, headers):
+        return json.dumps([
+            host,
+            '/'.join(str(part) for part in url),
+            sorted((params or {}).items()),
+            [headers.get(name) for name in KEY_HEADERS],
+        ])
+
+    def lookup(self, host, url, params, headers):
+        '''Cached response of the request
+
+        :return:  CacheEntry or None
+        '''
+
+        ttl = self._ttl(url)
+        if ttl is None:
+            return None
+
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, total, body, stored FROM responses WHERE key = ?',
+                [self._key(host, url, params, headers)]).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+
+        etag, last_modified, total, body, stored = row
+
+        validators = {}
+        if etag:
+            validators['If-None-Match'] = etag
+        if last_modified:
+            validators['If-Modified-Since'] = last_modified
+
+        fresh = time() - stored < ttl
+        if fresh:
+            self.touch(host, url, params, headers, refresh=False)
+
+        return CacheEntry(
+            result=json.loads(body.decode('utf-8')) if body else None,
+            headers={'X-Total': total} if total is not None else {},
+            validators=validators,
+            fresh=fresh)
+
+    def touch(self, host, url, params, headers, refresh=True):
+        '''Mark cached response as used (as hit), refresh it after revalidation'''
+
+        now = time()
+        sql = 'UPDATE responses SET accessed = ? WHERE key = ?'
+        data = [now, self._key(host, url, params, headers)]
+        if refresh:
+            sql = 'UPDATE responses SET accessed = ?, stored = ? WHERE key = ?'
+            data = [now, now, self._key(host, url, params, headers)]
+
+        with self._lock:
+            self._stats['revalidations' if refresh else 'hits'] += 1
+            self.connection.execute(sql, data)
+
+    def store(self, host, url, params, headers, response):
+        '''Save successful response of the request'''
+
+        if self._ttl(url) is None or response.status_code != 200:
+            return
+
+        now = time()
+        with self._lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [self._key(host, url, params, headers),
+                 response.headers.get('ETag'),
+                 response.headers.get('Last-Modified'),
+                 response.headers.get('X-Total'),
+                 response.content,
+                 now,
+                 now])
+            self._evict()
+
+    def _evict(self):
+        '''Remove least recently used responses over the limit'''
+
+        count = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self._max_entries:
+            self.logger.debug('Evicting %d responses', count - self._max_entries)
+            self.connection.execute(
+                '''DELETE FROM responses WHERE key IN (
+                       SELECT key FROM responses ORDER BY accessed LIMIT ?)''',
+                [count - self._max_entries])
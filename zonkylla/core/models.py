@@ -6,56 +6,223 @@
 '''Models module'''
 
 from abc import ABCMeta, abstractproperty
+from collections import OrderedDict
 import logging
 
 from dateutil.relativedelta import relativedelta
 
+from zonkylla.abstract.abs_database import Database
 from .database import DBModelerClient
 from .utils import iso2datetime
 
 
-class AbstractModel(metaclass=ABCMeta):
+class ModelMeta(ABCMeta):
+    '''Metaclass of models
+
+    Model with '_table' gets slots for all columns of the table in
+    schema, so its instances carry no __dict__. Every model class gets
+    its own logger.
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        table = namespace.get('_table')
+        if table is not None:
+            columns = Database().schema[table]['columns']
+            namespace['__slots__'] = tuple(columns)
+            namespace['_column_types'] = OrderedDict(columns)
+        else:
+            namespace.setdefault('__slots__', ())
+
+        namespace['logger'] = logging.getLogger('zonkylla.Models.{}'.format(name))
+        return ABCMeta.__new__(mcs, name, bases, namespace)
+
+
+class Query():
+    '''Lazy query of records of a model
+
+    Conditions, ordering, projection and limit are pushed down into SQL
+    and nothing is read before the query is iterated. Every method
+    returns new query, so queries can be shared and refined.
+
+    >>> UserInvestment.where(status='ACTIVE').order_by('nextPaymentDate').iter()
+    '''
+
+    def __init__(self, model):
+        self._model = model
+        self._columns = None
+        self._conditions = OrderedDict()
+        self._order_by = []
+        self._limit = None
+
+    def _copy(self):
+        query = Query(self._model)
+        query._columns = self._columns  # pylint: disable=protected-access
+        query._conditions = OrderedDict(self._conditions)  # pylint: disable=protected-access
+        query._order_by = list(self._order_by)  # pylint: disable=protected-access
+        query._limit = self._limit  # pylint: disable=protected-access
+        return query
+
+    def _check_columns(self, columns):
+        column_types = self._model._column_types  # pylint: disable=protected-access
+        for column in columns:
+            if column.lstrip('-') not in column_types:
+                raise ValueError("'{}' is not a column of {}".format(
+                    column, self._model.__name__))
+
+    def where(self, **conditions):
+        '''Query with records matching all conditions
+
+        Value could be single value, None or list, tuple or set of values.
+        '''
+        self._check_columns(conditions)
+        query = self._copy()
+        query._conditions.update(conditions)  # pylint: disable=protected-access
+        return query
+
+    def order_by(self, *columns):
+        '''Query ordered by columns, prefix column by '-' for descending order'''
+        self._check_columns(columns)
+        query = self._copy()
+        query._order_by.extend(columns)  # pylint: disable=protected-access
+        return query
+
+    def select(self, *columns):
+        '''Query loading only given columns'''
+        self._check_columns(columns)
+        query = self._copy()
+        query._columns = list(columns)  # pylint: disable=protected-access
+        return query
+
+    def limit(self, count):
+        '''Query with at most count records'''
+        query = self._copy()
+        query._limit = count  # pylint: disable=protected-access
+        return query
+
+    def iter(self):
+        '''Generator of records streamed from database'''
+
+        rows = self._model.database.select(
+            self._model._table,  # pylint: disable=protected-access
+            self._columns, self._conditions, self._order_by, self._limit)
+
+        keys = None
+        for row in rows:
+            if keys is None:
+                keys = row.keys()
+            yield self._model._from_row(keys, row)  # pylint: disable=protected-access
+
+    def __iter__(self):
+        return self.iter()
+
+    def all(self):
+        '''List of all records'''
+        return list(self.iter())
+
+    def first(self):
+        '''The first record or None'''
+        return next(self.limit(1).iter(), None)
+
+
+class AbstractModel(metaclass=ModelMeta):
     '''Abstract model'''
 
     database = DBModelerClient()
-    logger = logging.getLogger('zonkylla.Models.AbstractModel')
 
+    _table = None
+    _column_types = OrderedDict()
     _get_one_database_method_name = None
     _get_all_database_method_name = None
 
     @classmethod
-    def all(cls):
-        '''Returns all records from DB'''
-        return [cls(data) for data in cls._load_all()]
+    def all(cls, record_ids=None):
+        '''Returns all records from DB (only those with given IDs if any)'''
+        rows = cls._load_all(record_ids)
+        if not rows:
+            return []
+
+        # rows share columns, so their names are taken only once
+        keys = rows[0].keys()
+        return [cls._from_row(keys, row) for row in rows]
 
     @classmethod
-    def find(cls, record_id):
-        '''Returns one records from DB by it's ID'''
-        return cls(cls._load_one(record_id))
+    def query(cls):
+        '''Lazy query of all records'''
+        return Query(cls)
 
     @classmethod
-    def _load_all(cls):
-        db_result = cls._get_all_database_method()()
+    def where(cls, **conditions):
+        '''Lazy query of records matching conditions, see Query.where'''
+        return Query(cls).where(**conditions)
 
-        result_all = []
+    @classmethod
+    def iter_all(cls):
+        '''Generator of all records streamed from DB'''
+        return Query(cls).iter()
 
-        for row in db_result:
-            result_data = {}
-            for key in list(row.keys()):
-                result_data[key] = row[key]
-            result_all.append(result_data)
+    @classmethod
+    def find(cls, record_id):
+        '''Returns one records from DB by it's ID
+
+        Models already loaded are served from the identity map.
+        '''
 
-        return result_all
+        model = cls.database.identity_map.get(cls._table, record_id)
+        if model is None:
+            model = cls(cls._load_one(record_id))
+            cls.database.identity_map.put(cls._table, record_id, model)
+        return model
 
     @classmethod
-    def _load_one(cls, record_id):
-        db_result = cls._get_one_database_method()(record_id)
+    def find_many(cls, record_ids):
+        '''Returns records from DB by their IDs in the same order
+
+        Records are loaded by one query, models already loaded are served
+        from the identity map. IDs which are not found are logged and
+        skipped.
+        '''
+
+        record_ids = list(record_ids)
+        identity_map = cls.database.identity_map
+
+        models = {}
+        to_load = []
+        for record_id in OrderedDict.fromkeys(record_ids):
+            model = identity_map.get(cls._table, record_id)
+            if model is None:
+                to_load.append(record_id)
+            else:
+                models[record_id] = model
+
+        if to_load:
+            for model in Query(cls).where(id=to_load).iter():
+                models[model.id] = model
+                identity_map.put(cls._table, model.id, model)
+
+        not_found = [record_id for record_id in to_load if record_id not in models]
+        if not_found:
+            cls.logger.warning('%d records of %s not found: %s',
+                               len(not_found), cls.__name__, not_found)
+
+        return [models[record_id] for record_id in record_ids if record_id in models]
 
-        result_data = {}
-        for key in list(db_result.keys()):
-            result_data[key] = db_result[key]
+    @classmethod
+    def _from_row(cls, keys, row):
+        '''Model filled from values of row with given column names'''
+        model = cls.__new__(cls)
+        for key, value in zip(keys, row):
+            setattr(model, key, value)
+        return model
+
+    @classmethod
+    def _load_all(cls, record_ids=None):
+        if record_ids is not None:
+            record_ids = list(record_ids)
+        return cls._get_all_database_method()(record_ids)
 
-        return result_data
+    @classmethod
+    def _load_one(cls, record_id):
+        return cls._get_one_database_method()(record_id)
 
     @classmethod
     def _get_one_database_method(cls):
@@ -72,8 +239,7 @@ class AbstractModel(metaclass=ABCMeta):
         return getattr(cls.database, method_name)
 
     def __init__(self, data):
-        self.logger = logging.getLogger(
-            'zonkylla.Models.{}'.format(type(self).__name__))
+        '''Init model from data (dict or row) with columns of its table'''
 
         self.logger.debug('Initializing %s with ID: %s',
                           type(self).__name__, data['id'])
@@ -83,19 +249,22 @@ class AbstractModel(metaclass=ABCMeta):
         # database.create_if_not_exist()
         # database.check_db_version()
 
-        self.__dict__ = data
+        for key in data.keys():
+            setattr(self, key, data[key])
 
     def __str__(self):
         result = ''
         result += type(self).__name__ + ':\n'
-        for key, value in self.__dict__.items():
-            result += key + ': ' + str(value) + '\n'
+        for key in self.__slots__:
+            result += key + ': ' + str(getattr(self, key, None)) + '\n'
         return result
 
 
 class InvestmentMixin(metaclass=ABCMeta):
     '''Attributes needed for investment'''
 
+    __slots__ = ()
+
     @property
     @abstractproperty
     def principal_to_pay(self):
@@ -124,6 +293,7 @@ class InvestmentMixin(metaclass=ABCMeta):
 class Loan(AbstractModel, InvestmentMixin):
     '''Loan model'''
 
+    _table = 'a_loans'
     _get_one_database_method_name = 'get_loan'
     _get_all_database_method_name = 'get_loans'
 
@@ -151,6 +321,7 @@ class Loan(AbstractModel, InvestmentMixin):
 class LoanInvestment(AbstractModel):
     '''LoanInvestment model'''
 
+    _table = 'a_loan_investments'
     _get_one_database_method_name = 'get_loan_investment'
     _get_all_database_method_name = 'get_loan_investments'
 
@@ -162,6 +333,7 @@ class LoanInvestment(AbstractModel):
 class UserInvestment(AbstractModel, InvestmentMixin):
     '''UserInvestment model'''
 
+    _table = 'a_user_investments'
     _get_one_database_method_name = 'get_user_investment'
     _get_all_database_method_name = 'get_user_investments'
 
@@ -189,6 +361,7 @@ class UserInvestment(AbstractModel, InvestmentMixin):
 class Transaction(AbstractModel):
     '''Transaction model'''
 
+    _table = 'a_transactions'
     _get_one_database_method_name = 'get_transaction'
     _get_all_database_method_name = 'get_transactions'
 
@@ -200,6 +373,7 @@ class Transaction(AbstractModel):
 class Notification(AbstractModel):
     '''Notification model'''
 
+    _table = 'a_notifications'
     _get_one_database_method_name = 'get_notification'
     _get_all_database_method_name = 'get_notifications'
 
@@ -211,6 +385,7 @@ class Notification(AbstractModel):
 class Wallet(AbstractModel):
     '''Wallet model'''
 
+    _table = 'a_wallet'
     _get_one_database_method_name = 'get_wallet'
     _get_all_database_method_name = 'get_wallets'
 
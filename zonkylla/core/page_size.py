@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Page size policy module'''
+
+import logging
+import threading
+
+from zonkylla.abstract.singleton_meta import Singleton
+from .config import Config
+from .utils import url2endpoint
+
+# HTTP status codes which mean that the page was too big for server
+REJECTED_STATUS_CODES = (413,)
+# HTTP status codes which could mean it as well as invalid request,
+# smaller page is tried only once to find out
+AMBIGUOUS_STATUS_CODES = (400, 422)
+
+
+class PageSizePolicy(metaclass=Singleton):
+    '''Page size negotiated per endpoint
+
+    Every endpoint starts with the size configured in the [page_size]
+    section of configuration. The size is halved when the server rejects
+    the page (HTTP 400 and 422 are tried with half size only once, they
+    usually mean invalid request) and lowered to the number of received items when the server
+    truncates the page. The last size which worked is used for following
+    requests of the same endpoint.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger('zonkylla.Core.PageSizePolicy')
+
+        self._lock = threading.Lock()
+        self._sizes = {}
+
+    def size(self, url_parts):
+        '''Page size which should be used for given endpoint'''
+
+        endpoint = url2endpoint(url_parts)
+        with self._lock:
+            if endpoint not in self._sizes:
+                self._sizes[endpoint] = Config().page_size(endpoint)
+            return self._sizes[endpoint]
+
+    def _record(self, endpoint, size, reason):
+        with self._lock:
+            self._sizes[endpoint] = size
+        self.logger.debug("Page size of '%s' set to %d (%s)", endpoint, size, reason)
+
+    @staticmethod
+    def is_ambiguous(status_code):
+        '''Boolean if the status code doesn't have to mean too big page'''
+        return status_code in AMBIGUOUS_STATUS_CODES
+
+    def rejected(self, url_parts, size, status_code):
+        '''Server rejected page of given size
+
+        :return:  smaller size which should be tried or None
+        '''
+
+        minimum = Config().min_page_size
+        if status_code not in REJECTED_STATUS_CODES + AMBIGUOUS_STATUS_CODES or \
+                size <= minimum:
+            return None
+
+        new_size = max(minimum, size // 2)
+        self._record(url2endpoint(url_parts), new_size,
+                     'HTTP {} for size {}'.format(status_code, size))
+        return new_size
+
+    def restore(self, url_parts, size):
+        '''Smaller page didn't help, the size which was used is kept'''
+        self._record(url2endpoint(url_parts), size, 'the request was invalid')
+
+    def received(self, url_parts, size, count, total):
+        '''Server returned first page with count items out of total
+
+        :return:  size which the server really uses
+        '''
+
+        endpoint = url2endpoint(url_parts)
+        if 0 < count < size and count < total:
+            self._record(endpoint, count, 'truncated from {}'.format(size))
+            return count
+
+        self.logger.debug("Page size of '%s' is %d", endpoint, size)
+        return size
@@ -5,19 +5,67 @@
 
 '''Payment plan module'''
 
-from dateutil.relativedelta import relativedelta
+from calendar import monthrange
+from collections import OrderedDict
+from datetime import datetime
 
 from .utils import iso2datetime
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def add_months(date, months):
+    '''Date shifted by months, day is clipped to the end of month
+
+    It's the same as adding relativedelta(months=months), only faster.
+    '''
+    month_index = date.month - 1 + months
+    year = date.year + month_index // 12
+    month = month_index % 12 + 1
+    return date.replace(year=year, month=month,
+                        day=min(date.day, monthrange(year, month)[1]))
+
 
 class PaymentPlan():
-    '''Payment plan class'''
+    '''Payment plan class
+
+    Monthly interest, annuity factor and monthly payment are computed
+    once, the calendar is produced by recurrence of discount factors
+    instead of exponentiation in every step.
+    '''
 
     def __init__(self, investment):
-        self._amount = investment.principal_to_pay
-        self._interest_rate = investment.interest_rate
-        self._term_in_months = investment.remaining_months
-        self._start_date = iso2datetime(investment.next_payment_date)
+        self._setup(investment.principal_to_pay,
+                    investment.interest_rate,
+                    investment.remaining_months,
+                    iso2datetime(investment.next_payment_date))
+
+    @classmethod
+    def from_values(cls, amount, interest_rate, term_in_months, start_date):
+        '''Payment plan of given values instead of investment'''
+        plan = cls.__new__(cls)
+        # pylint: disable=protected-access
+        plan._setup(amount, interest_rate, term_in_months, start_date)
+        return plan
+
+    def _setup(self, amount, interest_rate, term_in_months, start_date):
+        self._amount = amount
+        self._interest_rate = interest_rate
+        self._term_in_months = term_in_months
+        self._start_date = start_date
+
+        self._monthly_interest = 1 + (interest_rate / 12.0)
+        # growth of the amount within the whole term
+        self._growth = self._monthly_interest ** term_in_months
+        if self._growth == 1:
+            # limit of annuity for zero interest
+            self._monthly_payment = amount / max(term_in_months, 1)
+        else:
+            self._monthly_payment = amount * self._growth * (self._monthly_interest - 1) / \
+                (self._growth - 1)
 
     @property
     def amount(self):
@@ -39,34 +87,148 @@ class PaymentPlan():
         '''Payment start date'''
         return self._start_date
 
+    def _discount(self, step):
+        '''Part of monthly payment which pays principal in the step'''
+        return self._monthly_interest ** (step - self._term_in_months)
+
     def period_to_pay_principal(self, step):
         '''Period to pay principal'''
-        return self.monthly_payment * (1 / (self.monthly_interest) ** (self.term_in_months - step))
+        return self._monthly_payment * self._discount(step)
 
     def period_to_pay_interest(self, step):
         '''Period to pay interest'''
-        return self.monthly_payment * \
-            (1 - (1 / (self.monthly_interest) ** (self.term_in_months - step)))
+        return self._monthly_payment * (1 - self._discount(step))
+
+    def instalment(self, step):
+        '''Return one row of payment calendar (step starts from 0)'''
+        return self._row(step, self._discount(step))
+
+    def _row(self, step, discount):
+        return {
+            'payment_number': step + 1,
+            'paid_total': (step + 1) * self._monthly_payment,
+            'period_to_pay_principal': self._monthly_payment * discount,
+            'period_to_pay_interest': self._monthly_payment * (1 - discount),
+            'payment_date': add_months(self._start_date, step),
+        }
+
+    def iter_payment_calendar(self):
+        '''Generator of rows of payment calendar, one for every instalment'''
+        discount = 1 / self._growth
+        for step in range(0, self._term_in_months):
+            yield self._row(step, discount)
+            discount *= self._monthly_interest
 
     @property
     def payment_calendar(self):
         '''Return payment calendar'''
-        return [{
-            'payment_number': i + 1,
-            'paid_total': (i + 1) * self.monthly_payment,
-            'period_to_pay_principal': self.period_to_pay_principal(i),
-            'period_to_pay_interest': self.period_to_pay_interest(i),
-            'payment_date': self.start_date + relativedelta(months=i),
-        } for i in range(0, self.term_in_months + 1)]
+        return list(self.iter_payment_calendar())
 
     @property
     def monthly_interest(self):
         '''Monthly interest'''
-        return 1 + (self.interest_rate / 12.0)
+        return self._monthly_interest
 
     @property
     def monthly_payment(self):
         '''Return monthly payment'''
-        return self.amount * ((self.monthly_interest ** self.term_in_months) *
-                              (self.monthly_interest - 1)) / \
-            ((self.monthly_interest ** self.term_in_months) - 1)
+        return self._monthly_payment
+
+
+class PortfolioPaymentPlan():
+    '''Payment plans of many investments computed at once
+
+    Calendars of all investments are computed by vectorised operations
+    when NumPy is installed (pip install zonkylla[numpy]), plan by plan
+    otherwise. Both give the same rows as PaymentPlan of every investment,
+    only payment dates are naive (in time zone of next payment date).
+    '''
+
+    def __init__(self, investments):
+        self._ids = []
+        self._amounts = []
+        self._interest_rates = []
+        self._terms_in_months = []
+        self._start_dates = []
+
+        for investment in investments:
+            self._ids.append(investment.id)
+            self._amounts.append(investment.principal_to_pay)
+            self._interest_rates.append(investment.interest_rate)
+            self._terms_in_months.append(investment.remaining_months)
+            self._start_dates.append(
+                iso2datetime(investment.next_payment_date).replace(tzinfo=None))
+
+    @property
+    def payment_calendar(self):
+        '''Return payment calendar of all investments
+
+        :return:  OrderedDict of columns (NumPy arrays or lists) with
+                  'investment_id' and keys of PaymentPlan.payment_calendar
+        '''
+        if numpy is None:
+            return self._python_payment_calendar()
+        return self._numpy_payment_calendar()
+
+    def _python_payment_calendar(self):
+        calendar = OrderedDict((column, []) for column in (
+            'investment_id', 'payment_number', 'paid_total',
+            'period_to_pay_principal', 'period_to_pay_interest', 'payment_date'))
+
+        for investment_id, amount, interest_rate, term_in_months, start_date in zip(
+                self._ids, self._amounts, self._interest_rates,
+                self._terms_in_months, self._start_dates):
+            plan = PaymentPlan.from_values(
+                amount, interest_rate, term_in_months, start_date)
+
+            for row in plan.iter_payment_calendar():
+                calendar['investment_id'].append(investment_id)
+                for column, value in row.items():
+                    calendar[column].append(value)
+
+        return calendar
+
+    def _numpy_payment_calendar(self):
+        amounts = numpy.array(self._amounts, dtype=float)
+        monthly_interest = 1 + numpy.array(self._interest_rates, dtype=float) / 12.0
+        terms = numpy.array(self._terms_in_months, dtype=numpy.int64)
+
+        growth = monthly_interest ** terms
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            monthly_payments = numpy.where(
+                growth == 1,
+                amounts / numpy.maximum(terms, 1),
+                amounts * growth * (monthly_interest - 1) / (growth - 1))
+
+        # one row for every instalment (step 0..term - 1) of every investment
+        rows = terms
+        index = numpy.repeat(numpy.arange(len(terms)), rows)
+        steps = numpy.arange(rows.sum()) - numpy.repeat(numpy.cumsum(rows) - rows, rows)
+
+        payments = monthly_payments[index]
+        discounts = monthly_interest[index] ** (steps - terms[index])
+
+        return OrderedDict([
+            ('investment_id', numpy.array(self._ids)[index]),
+            ('payment_number', steps + 1),
+            ('paid_total', (steps + 1) * payments),
+            ('period_to_pay_principal', payments * discounts),
+            ('period_to_pay_interest', payments * (1 - discounts)),
+            ('payment_date', self._numpy_payment_dates(index, steps)),
+        ])
+
+    def _numpy_payment_dates(self, index, steps):
+        '''Start dates shifted by steps months, day is clipped to month's end'''
+
+        starts = numpy.array(self._start_dates or [datetime.min], dtype='datetime64[s]')
+        start_months = starts.astype('datetime64[M]')
+        start_days = starts.astype('datetime64[D]')
+        days_of_month = start_days - start_months.astype('datetime64[D]')
+        times_of_day = starts - start_days.astype('datetime64[s]')
+
+        months = start_months[index] + steps
+        first_days = months.astype('datetime64[D]')
+        last_days = (months + 1).astype('datetime64[D]') - numpy.timedelta64(1, 'D')
+        days = numpy.minimum(first_days + days_of_month[index], last_days)
+
+        return days.astype('datetime64[s]') + times_of_day[index]
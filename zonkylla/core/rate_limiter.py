@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Rate limiter module'''
+
+import logging
+import threading
+from time import monotonic, sleep
+
+from zonkylla.abstract.singleton_meta import Singleton
+from .config import Config
+
+
+class RateLimiter(metaclass=Singleton):
+    '''Token bucket rate limiter shared by all Zonky clients
+
+    The bucket is implemented as a virtual scheduling algorithm: every
+    caller reserves its own slot under the lock and then sleeps until
+    the slot's deadline outside of the lock, so concurrent callers are
+    served in order without polling.
+
+    Rate (requests per second) and burst (requests which can be sent at
+    once) are taken from configuration.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger('zonkylla.Core.RateLimiter')
+
+        self._interval = 1.0 / Config().rate
+        self._burst = max(1, Config().burst)
+        self._lock = threading.Lock()
+        self._theoretical_arrival = monotonic()
+
+        self._stats = {
+            'requests': 0,
+            'throttled': 0,
+            'throttled_time': 0.0,
+            'penalties': 0,
+        }
+
+    @property
+    def stats(self):
+        '''Counters of requests and time spent by throttling'''
+        with self._lock:
+            stats = dict(self._stats)
+        stats['throttled_time'] = round(stats['throttled_time'], 3)
+        return stats
+
+    def acquire(self):
+        '''Block until the next request is allowed'''
+
+        with self._lock:
+            now = monotonic()
+            arrival = max(self._theoretical_arrival, now)
+            delay = arrival - (self._burst - 1) * self._interval - now
+            self._theoretical_arrival = arrival + self._interval
+
+            self._stats['requests'] += 1
+            if delay > 0:
+                self._stats['throttled'] += 1
+                self._stats['throttled_time'] += delay
+
+        if delay > 0:
+            self.logger.debug('Throttled for %.3f s', delay)
+            sleep(delay)
+
+    def penalize(self, seconds):
+        '''Hold all requests for given time (e.g. due to Retry-After)'''
+
+        with self._lock:
+            now = monotonic()
+            # the whole burst must be spent before next request is allowed
+            arrival = now + max(0.0, seconds) + (self._burst - 1) * self._interval
+            self._theoretical_arrival = max(self._theoretical_arrival, arrival)
+            self._stats['penalties'] += 1
+
+        self.logger.warning('Zonky asked to slow down, waiting %.3f s', seconds)
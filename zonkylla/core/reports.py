@@ -5,16 +5,53 @@
 
 '''Reports module'''
 
+from datetime import datetime, timedelta, timezone
+import heapq
+from itertools import islice, takewhile
+from operator import itemgetter
+
+from .database import DBModelerClient
 from .models import UserInvestment
-from .payment_plan import PaymentPlan
+from .payment_plan import PaymentPlan, PortfolioPaymentPlan
+
+
+def iter_upcoming_transactions(until=None, limit=None):
+    '''Generator of dicts with upcoming transactions ordered by payment date
+
+    Calendars of investments (each of them is ordered already) are merged
+    lazily, so only rows which are needed are computed and memory is
+    bounded by number of investments.
+
+    :param until:  the last payment date (timezone aware datetime) or
+                   timedelta from now, e.g. timedelta(days=30)
+    :param limit:  maximal number of transactions
+    '''
+
+    if isinstance(until, timedelta):
+        until = datetime.now(timezone.utc) + until
+
+    calendars = [PaymentPlan(ui).iter_payment_calendar() for ui in UserInvestment.iter_all()]
+    transactions = heapq.merge(*calendars, key=itemgetter('payment_date'))
+
+    if until is not None:
+        transactions = takewhile(lambda t: t['payment_date'] <= until, transactions)
+
+    return islice(transactions, limit)
+
+
+def upcoming_transactions(until=None, limit=None):
+    '''Returns list of dicts with upcoming transactions
+
+    See iter_upcoming_transactions for parameters.
+    '''
+    return list(iter_upcoming_transactions(until, limit))
 
 
-def upcoming_transactions():
-    '''Returns list of dicts with upcoming transactions'''
-    calendars = [PaymentPlan(ui).payment_calendar for ui in UserInvestment.all()]
+def portfolio_payment_calendar():
+    '''Returns payment calendar of all user investments as columns'''
+    return PortfolioPaymentPlan(UserInvestment.all()).payment_calendar
 
-    # flatten nested list of events
-    transactions = [item for sublist in calendars for item in sublist]
 
-    transactions.sort(key=lambda t: t['payment_date'])
-    return transactions
+def monthly_projected_payments(since=None, until=None):
+    '''Returns projected inflow by months, see DBModelerClient.monthly_projected_payments'''
+    return DBModelerClient().monthly_projected_payments(since, until)
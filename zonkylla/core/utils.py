@@ -5,14 +5,89 @@
 
 '''Util module'''
 
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import re
+
 import dateutil.parser
 
+# the same timestamps repeat a lot (e.g. payment dates), parsed ones are kept
+ISO2DATETIME_CACHE_SIZE = 4096
+
+# datetime.fromisoformat is available since Python 3.7
+FROMISOFORMAT = getattr(datetime, 'fromisoformat', None)
+
+ISO_DATETIME_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+TIMEZONES = {'Z': timezone.utc}
+
+
+def _timezone(offset):
+    '''Timezone of offset (Z, +HH:MM or +HHMM), instances are shared'''
+    if offset not in TIMEZONES:
+        sign = -1 if offset[0] == '-' else 1
+        hours, minutes = int(offset[1:3]), int(offset[-2:])
+        TIMEZONES[offset] = timezone(sign * timedelta(hours=hours, minutes=minutes))
+    return TIMEZONES[offset]
+
+
+def _normalize_offset(iso_date):
+    '''Offset in form accepted by datetime.fromisoformat of Python < 3.11'''
+    if iso_date.endswith('Z'):
+        return iso_date[:-1] + '+00:00'
+    if len(iso_date) > 10 and iso_date[-5] in '+-' and iso_date[-3] != ':':
+        return iso_date[:-2] + ':' + iso_date[-2:]
+    return iso_date
+
+
+def _parse_iso(iso_date):
+    '''Parse fixed ISO format by regular expression (Python 3.6)
 
+    :return:  datetime or None if the format doesn't match
+    '''
+    match = ISO_DATETIME_RE.match(iso_date)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    return datetime(
+        int(year), int(month), int(day),
+        int(hour or 0), int(minute or 0), int(second or 0),
+        int((fraction or '0').ljust(6, '0')),
+        _timezone(offset) if offset else None)
+
+
+@lru_cache(maxsize=ISO2DATETIME_CACHE_SIZE)
 def iso2datetime(iso_date):
-    '''Convert ISO datetime format to datetime'''
-    return dateutil.parser.parse(iso_date)
+    '''Convert ISO datetime format to datetime
+
+    Timestamps of Zonky (e.g. 2017-08-20T00:00:00.000+02:00) are parsed
+    by datetime.fromisoformat (or regular expression on Python 3.6),
+    dateutil is used only for other formats. Datetime is returned as it is.
+    '''
+
+    if isinstance(iso_date, datetime):
+        return iso_date
+
+    if FROMISOFORMAT is not None:
+        try:
+            return FROMISOFORMAT(_normalize_offset(iso_date))
+        except ValueError:
+            pass
+
+    return _parse_iso(iso_date) or dateutil.parser.parse(iso_date)
 
 
 def datetime2iso(dt_struct):
     '''Convert datetime to ISO datetime format'''
     return dt_struct.isoformat(timespec='milliseconds')
+
+
+def url2endpoint(url_parts):
+    '''Name of endpoint of url given as tuple, IDs are replaced by {id}'''
+    return '/'.join(
+        '{id}' if str(part).isdigit() else str(part).strip('/')
+        for part in url_parts)
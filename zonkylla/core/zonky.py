@@ -7,22 +7,93 @@
 
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import logging
-from time import sleep
 from itertools import chain
+from math import ceil
+from random import uniform
+from time import sleep
 from urllib.parse import urljoin
 import pkg_resources
 
 from oauthlib.oauth2 import LegacyApplicationClient
 from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import requests
 
-from .utils import datetime2iso
+from .config import Config
+from .http_cache import HttpCache
+from .page_size import PageSizePolicy
+from .rate_limiter import RateLimiter
+from .utils import datetime2iso, iso2datetime
+
+MAX_THROTTLED_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1.0
+MAX_BACKOFF = 60.0
+CHECKPOINT_CHUNK_SIZE = 100
+
+
+def is_transient(err):
+    """Boolean if request failed due to error which could pass"""
+
+    if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return err.response.status_code >= 500 or err.response.status_code == 429
+
+    return False
+
+
+def backoff(attempt):
+    """Seconds to wait before next attempt, exponential with full jitter"""
+    return uniform(0, min(MAX_BACKOFF, Config().backoff * 2 ** attempt))
+
+
+def retry_after(response):
+    """Seconds to wait due to Retry-After header of response"""
+
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return DEFAULT_RETRY_AFTER
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        retry_dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+    return (retry_dt - datetime.now(retry_dt.tzinfo)).total_seconds()
+
+
+def connection_stats(adapters):
+    """Counters of new and reused connections of given transport adapters
+
+    :return:  dict with numbers of requests, connections (handshakes)
+              and requests sent over reused connections
+    """
 
-DEFAULT_WAIT_TIME = 0.1
-DEFAULT_PAGE_SIZE = 100
+    requests_count = 0
+    connections_count = 0
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+
+    return {
+        'requests': requests_count,
+        'connections': connections_count,
+        'reused': requests_count - connections_count,
+    }
 
 
 class AbstractClient(metaclass=ABCMeta):
@@ -34,8 +105,12 @@ class AbstractClient(metaclass=ABCMeta):
             'Accept': 'application/json',
             'Content-Type': 'application/json',
             'User-Agent': self._user_agent,
+            'Accept-Encoding': 'gzip, deflate' if Config().compression else 'identity',
         }
-        self._time_lock = datetime.now()
+        self._rate_limiter = RateLimiter()
+        self._prefetch = Config().prefetch
+        self._page_size = PageSizePolicy()
+        self._cache = HttpCache()
         self.logger = logging.getLogger('zonkylla.AbstractClient')
 
     @property
@@ -48,19 +123,218 @@ class AbstractClient(metaclass=ABCMeta):
         return 'zonkylla/{} ({})'.format(pkg_resources.require('zonkylla')
                                          [0].version, 'https://github.com/zonkylla/zonkylla')
 
-    def _wait(self):
-        '''Wait until time lock is released'''
-        while datetime.now() < self._time_lock:
-            sleep(DEFAULT_WAIT_TIME)
+    def mount(self, adapter):
+        """Use given transport adapter (connection pool) for requests"""
+        self._client().mount('https://', adapter)
+        self._client().mount('http://', adapter)
 
-    def _update_time_lock(self):
-        '''Set new time lock'''
-        self._time_lock = datetime.now() + timedelta(milliseconds=500)
+    def connection_stats(self):
+        """Counters of new and reused connections"""
+        adapters = {id(adapter): adapter for adapter in self._client().adapters.values()}
+        return connection_stats(adapters.values())
 
     def _join_url(self, url_parts):
         '''Join url'''
         return urljoin(self._host, '/'.join(s.strip('/') for s in url_parts))
 
+    def _prepare_headers(self, url, headers=None):
+        """Complete headers of request by defaults"""
+
+        if headers is None:
+            headers = {}
+
+        headers.update(self._headers)
+        headers.setdefault('X-Page', str(0))
+        headers.setdefault('X-Size', str(self._page_size.size(url)))
+
+        return headers
+
+    def _send(self, method, url, params, headers):
+        """Send request to Zonky, repeat it while Zonky asks to slow down
+
+        :return:        response
+        """
+
+        for _ in range(MAX_THROTTLED_RETRIES):
+            self._rate_limiter.acquire()
+            response = self._client().request(
+                method.lower(),
+                self._join_url(url),
+                params=params,
+                headers=headers,
+                **self._additional_params()
+            )
+            if response.status_code != 429:
+                break
+            self._rate_limiter.penalize(retry_after(response))
+
+        response.raise_for_status()
+        return response
+
+    def _send_with_retries(self, method, url, params, headers):
+        """Send request to Zonky
+
+        GET requests failed due to connection or server errors are
+        repeated with exponential backoff.
+
+        :return:        response
+        """
+
+        attempt = 0
+        while True:
+            try:
+                return self._send(method, url, params, headers)
+            except requests.RequestException as err:
+                if method != 'GET' or attempt >= Config().retries or not is_transient(err):
+                    raise
+                delay = backoff(attempt)
+                self.logger.warning("Request of '%s' failed (%s), retrying in %.1f s",
+                                    self._join_url(url), err, delay)
+                sleep(delay)
+                attempt += 1
+
+    def _request_page(self, method, url, params, headers):
+        """Send one request to Zonky
+
+        GET responses of cached endpoints are served from HttpCache
+        while they are fresh and revalidated when they are stale.
+
+        :return:        tuple of json with result and response headers
+        """
+
+        cached = self._cache.lookup(self._host, url, params, headers) if method == 'GET' else None
+        if cached is not None and cached.fresh:
+            return cached.result, cached.headers
+
+        request_headers = headers
+        if cached is not None:
+            request_headers = dict(headers, **cached.validators)
+
+        response = self._send_with_retries(method, url, params, request_headers)
+
+        if cached is not None and response.status_code == 304:
+            self._cache.touch(self._host, url, params, headers)
+            return cached.result, cached.headers
+
+        if method == 'GET':
+            self._cache.store(self._host, url, params, headers, response)
+
+        result = response.json() if response.content else None
+
+        self.logger.debug("Result: '%s'", result)
+        return result, response.headers
+
+    def _request_first_page(self, method, url, params, headers, offset=0):
+        """Send the first request to Zonky and negotiate the page size
+
+        The page size of GET requests is lowered while the server rejects
+        it (only once for HTTP 400 and 422, the error is raised when it
+        doesn't help) and it is adjusted to the size the server uses when
+        the page is truncated. Other requests aren't idempotent, they are
+        sent only once.
+        The requested page is the one containing item on given offset,
+        items before offset are cut off.
+
+        :return:        tuple of json with result and response headers
+        """
+
+        # size and error before the size was lowered due to ambiguous status
+        probe = None
+
+        while True:
+            size = int(headers['X-Size'])
+            page = offset // size
+            headers['X-Page'] = str(page)
+
+            try:
+                result, response_headers = self._request_page(method, url, params, headers)
+            except requests.HTTPError as err:
+                if method != 'GET':
+                    raise
+                status_code = err.response.status_code
+                if probe is not None and self._page_size.is_ambiguous(status_code):
+                    # smaller page didn't help, the request itself is invalid
+                    self._page_size.restore(url, probe[0])
+                    raise probe[1]
+
+                new_size = self._page_size.rejected(url, size, status_code)
+                if new_size is None:
+                    raise
+                if self._page_size.is_ambiguous(status_code):
+                    probe = (size, err)
+                headers['X-Size'] = str(new_size)
+                continue
+
+            if method == 'GET' and isinstance(result, list) and 'X-Total' in response_headers:
+                new_size = self._page_size.received(
+                    url, size, len(result),
+                    int(response_headers['X-Total']) - page * size)
+                headers['X-Size'] = str(new_size)
+                if offset // new_size != page:
+                    # page boundaries moved, the offset is on another page
+                    continue
+
+            if offset and isinstance(result, list):
+                result = result[offset - page * int(headers['X-Size']):]
+
+            return result, response_headers
+
+    @staticmethod
+    def _following_pages(headers, response_headers):
+        """Numbers of pages which follow the requested one"""
+
+        if 'X-Total' not in response_headers:
+            return range(0)
+
+        xpage = int(headers['X-Page'])
+        xsize = int(headers['X-Size'])
+        xtotal = int(response_headers['X-Total'])
+
+        return range(xpage + 1, ceil(xtotal / xsize))
+
+    def _iter_pages(self, method, url, params=None, headers=None, offset=0):
+        """Generator of pages of response from Zonky
+
+        Pages are requested one by one as they are consumed.
+        Items before offset are skipped.
+        """
+
+        if params is None:
+            params = {}
+        headers = self._prepare_headers(url, headers)
+
+        result, response_headers = self._request_first_page(
+            method, url, params, headers, offset)
+        while True:
+            yield result
+
+            pages = self._following_pages(headers, response_headers)
+            if not pages:
+                return
+            if self._prefetch > 1:
+                yield from self._prefetch_pages(method, url, params, headers, pages)
+                return
+            headers['X-Page'] = str(pages[0])
+            result, response_headers = self._request_page(method, url, params, headers)
+
+    def _prefetch_pages(self, method, url, params, headers, pages):
+        """Request given pages concurrently and yield them in order
+
+        At most 'prefetch' pages are requested or waiting at once.
+        """
+
+        self.logger.debug('Prefetching %d pages of %s', len(pages), url)
+        with ThreadPoolExecutor(max_workers=self._prefetch) as executor:
+            futures = deque()
+            for page in pages:
+                futures.append(executor.submit(
+                    self._request_page, method, url, params,
+                    dict(headers, **{'X-Page': str(page)})))
+                if len(futures) >= self._prefetch:
+                    yield futures.popleft().result()[0]
+            while futures:
+                yield futures.popleft().result()[0]
+
     def _request(self, method, url, params=None, headers=None):
         """Method for sending of request to Zonky
 
@@ -70,35 +344,12 @@ class AbstractClient(metaclass=ABCMeta):
         :return:        json with result
         """
 
-        if params is None:
-            params = {}
-        if headers is None:
-            headers = {}
+        pages = self._iter_pages(method, url, params, headers)
 
-        headers.update(self._headers)
-        headers.setdefault('X-Page', str(0))
-        headers.setdefault('X-Size', str(DEFAULT_PAGE_SIZE))
-
-        self._wait()
-        response = self._client().request(
-            method.lower(),
-            self._join_url(url),
-            params=params,
-            headers=headers,
-            **self._additional_params()
-        )
-        self._update_time_lock()
+        result = next(pages)
+        for page in pages:
+            result.extend(page)
 
-        result = response.json() if response.content else None
-
-        if 'X-Total' in response.headers:
-            xpage = int(headers['X-Page'])
-            xsize = int(headers['X-Size'])
-            if ((xpage + 1) * xsize) < int(response.headers['X-Total']):
-                headers['X-Page'] = str(xpage + 1)
-                result = result + self._request(method, url, params, headers)
-
-        self.logger.debug("Result: '%s'", result)
         return result
 
     @abstractmethod
@@ -126,6 +377,19 @@ class AbstractClient(metaclass=ABCMeta):
         """DELETE Method"""
         return self._request('DELETE', url, params, headers)
 
+    def iter_pages(self, url, params=None, headers=None, offset=0):
+        """GET Method yielding pages of result as they arrive
+
+        Items before offset are skipped, so an interrupted download
+        could be resumed.
+        """
+        return self._iter_pages('GET', url, params, headers, offset)
+
+    def iter_items(self, url, params=None, headers=None):
+        """GET Method yielding items of paginated result one by one"""
+        for page in self.iter_pages(url, params, headers):
+            yield from page
+
 
 class OAuthClient(
         AbstractClient):  # pylint: disable=too-many-instance-attributes
@@ -207,33 +471,79 @@ class Client(AbstractClient):
         AbstractClient.__init__(self, host)
         self.logger = logging.getLogger('zonkylla.Client')
 
+        self._session = requests.Session()
+        self.mount(HTTPAdapter(pool_maxsize=Config().pool_size))
+
     def _client(self):
-        return requests
+        return self._session
 
 
 class Zonky:
     """Testing class"""
 
-    def __init__(self, host, username=None, password=None):
+    def __init__(self, host, username=None, password=None, workers=None):
         """Interface to zonky API
 
         :param host:
         :param username:
         :param password:
+        :param workers:  number of concurrent workers for per-loan downloads
         """
 
-        self._client = Client(host)
+        self.logger = logging.getLogger('zonkylla.Zonky')
+
+        self._workers = Config().workers if workers is None else workers
+
+        self._client = self._new_client(host)
 
         if username and password:
-            self._oauth_client = OAuthClient(host, username, password)
+            self._oauth_client = self._new_oauth_client(host, username, password)
         else:
             self._oauth_client = None
 
+        # all clients share one connection pool
+        self._adapter = HTTPAdapter(
+            pool_maxsize=max(Config().pool_size, self._workers, Config().prefetch))
+        for client in (self._client, self._oauth_client):
+            if client is not None:
+                client.mount(self._adapter)
+
+    def _new_client(self, host):
+        """Anonymous client"""
+        return Client(host)
+
+    def _new_oauth_client(self, host, username, password):
+        """Client authorized by user's credentials"""
+        return OAuthClient(host, username, password)
+
+    @staticmethod
+    def _loan_ids(transactions):
+        """Unique IDs of loans referenced by transactions"""
+        return list(OrderedDict.fromkeys(
+            trans['loanId'] for trans in transactions if trans['loanId']))
+
     @property
     def zonky_api_version(self):
         """Version of zonky API"""
         return self._client.zonky_api_version
 
+    @property
+    def connection_stats(self):
+        """Counters of new and reused connections"""
+        return connection_stats([self._adapter])
+
+    def _map(self, func, items):
+        """Apply func on every item, concurrently if more workers are set
+
+        Results are returned in the order of items.
+        """
+        if self._workers < 2:
+            return [func(item) for item in items]
+
+        self.logger.debug('Running %s with %d workers', func.__name__, self._workers)
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            return list(executor.map(func, items))
+
     def get_wallet(self):
         """Wallet"""
         return self._oauth_client.get(('users', 'me', 'wallet'))
@@ -243,8 +553,9 @@ class Zonky:
         return self._oauth_client.get(
             ('users', 'me', 'wallet', 'blocked-amounts'))
 
-    def get_transactions(self, from_dt=None):
-        """List of transactions"""
+    @staticmethod
+    def _transactions_query(from_dt=None):
+        """URL, params and headers of transactions query"""
         params = {}
         headers = {}
 
@@ -253,8 +564,16 @@ class Zonky:
 
         headers['X-Order'] = 'transaction.transactionDate'
 
-        return self._oauth_client.get(
-            ('users', 'me', 'wallet', 'transactions'), params, headers)
+        return ('users', 'me', 'wallet', 'transactions'), params, headers
+
+    def get_transactions(self, from_dt=None):
+        """List of transactions"""
+        return self._oauth_client.get(*self._transactions_query(from_dt))
+
+    def iter_transactions(self, from_dt=None, offset=0):
+        """Pages of transactions, the first offset transactions are skipped"""
+        return self._oauth_client.iter_pages(
+            *self._transactions_query(from_dt), offset=offset)
 
     def get_loans(self, from_dt=None):
         """List of loans on zonky"""
@@ -282,13 +601,9 @@ class Zonky:
         return self._oauth_client.get(
             ('loans', str(loan_id), 'investments'), params, headers)
 
-    def get_user_investments(self, time_type=None, from_dt=None):
-        """
-        User's investments
-
-        time_type  Type of from_dt. Default None. Else ('created', 'modified').
-        from_dt    Filter on time. Default None.
-        """
+    @staticmethod
+    def _user_investments_query(time_type=None, from_dt=None):
+        """URL, params and headers of user's investments query"""
 
         assert time_type in (None, 'created', 'modified')
 
@@ -303,8 +618,25 @@ class Zonky:
 
         headers['X-Order'] = 'timeCreated'
 
+        return ('users', 'me', 'investments'), params, headers
+
+    def get_user_investments(self, time_type=None, from_dt=None):
+        """
+        User's investments
+
+        time_type  Type of from_dt. Default None. Else ('created', 'modified').
+        from_dt    Filter on time. Default None.
+        """
         return self._oauth_client.get(
-            ('users', 'me', 'investments'), params, headers)
+            *self._user_investments_query(time_type, from_dt))
+
+    def iter_user_investments(self, time_type=None, from_dt=None, offset=0):
+        """Pages of user's investments, see get_user_investments
+
+        The first offset investments are skipped.
+        """
+        return self._oauth_client.iter_pages(
+            *self._user_investments_query(time_type, from_dt), offset=offset)
 
     def get_user_notifications(self):
         '''User's notifications'''
@@ -315,11 +647,135 @@ class Zonky:
         return self._oauth_client.get(
             ('users', 'me', 'notifications'), params, headers)
 
+    @staticmethod
+    def _update_pages(database, stage, iter_pages, insert):
+        '''Insert pages into database and save the progress of stage
+
+        :param iter_pages:  function returning pages from given offset
+        :param insert:      function inserting one page into database
+        '''
+
+        values = database.checkpoint(stage)
+        offset = int(values[-1]) if values else 0
+
+        for page in iter_pages(offset):
+            insert(page)
+            offset += len(page)
+            database.set_checkpoint(stage, offset)
+        database.add_checkpoint('done', [stage])
+
+    @staticmethod
+    def _pending_loan_ids(database, stage):
+        '''IDs of loans referenced by transactions and not done in the stage'''
+
+        done_ids = set(int(loan_id) for loan_id in database.checkpoint(stage))
+        loan_ids = OrderedDict.fromkeys(
+            int(loan_id) for loan_id in database.checkpoint('pending_loans'))
+        return [loan_id for loan_id in loan_ids if loan_id not in done_ids]
+
+    def _skip_complete_loans(self, database):
+        '''Mark loans which are complete in database as done
+
+        Those are covered loans after deadline which were downloaded
+        within 'loan_max_age' days, neither their details nor their
+        investments are downloaded again.
+        '''
+
+        loan_ids = self._pending_loan_ids(database, 'loans')
+        complete_ids = database.complete_loans(loan_ids, timedelta(days=Config().loan_max_age))
+
+        database.add_checkpoint('loans', complete_ids)
+        database.add_checkpoint('loan_investments', complete_ids)
+
+        print('# Skip {} of {} loans complete in database ({} requests avoided)'.format(
+            len(complete_ids), len(loan_ids), 2 * len(complete_ids)))
+
+    def _update_per_loan(self, database, stage, func, insert):
+        '''Download data of pending loans and save the progress of stage'''
+
+        loan_ids = self._pending_loan_ids(database, stage)
+
+        for start in range(0, len(loan_ids), CHECKPOINT_CHUNK_SIZE):
+            chunk = loan_ids[start:start + CHECKPOINT_CHUNK_SIZE]
+            insert(self._map(func, chunk))
+            database.add_checkpoint(stage, chunk)
+        database.add_checkpoint('done', [stage])
+
+    def _insert_transactions(self, database, transactions):
+        '''Insert transactions and remember loans referenced by them'''
+        database.insert_transactions(transactions)
+        database.add_checkpoint('pending_loans', self._loan_ids(transactions))
+
+    def _print_update_stats(self, database, stats):
+        '''Print number of written rows and speed of writing per table
+
+        Counters of connections, requests and statements are logged.
+        '''
+
+        for table, (rows, seconds) in sorted(stats.items()):
+            print('# Written {} rows into {} ({:.0f} rows/s)'.format(
+                rows, table, rows / seconds if seconds else 0))
+
+        self.logger.debug('Connections: %s', self.connection_stats)
+        self.logger.debug('Rate limiter: %s', RateLimiter().stats)
+        self.logger.debug('HTTP cache: %s', HttpCache().stats)
+        self.logger.debug('SQL statements: %s', database.statement_stats)
+
     def update(self, database):
-        '''Update all data for user from zonky'''
+        '''Update all data for user from zonky
+
+        The progress is saved in checkpoints, an interrupted update
+        continues where it stopped when it's run again.
+        '''
+
+        with database.bulk_ingest() as stats:
+            self._update(database)
+        self._print_update_stats(database, stats)
+
+    @staticmethod
+    def _begin_update(database):
+        '''Start the update or resume the interrupted one
+
+        The run checkpoint keeps the beginning of the downloaded period
+        and the start of the update. The start is recorded as the time
+        of the update even if it's finished by a resumed run, so the next
+        update doesn't miss anything posted while it was interrupted.
+
+        :return:  (beginning of the period or None, start of the update,
+                   stages which are done)
+        '''
+
+        run = database.checkpoint('run')
+        if run:
+            print('# Resume interrupted update')
+            last_dt = iso2datetime(run[0]) if run[0] else None
+            # checkpoints without the start record the previous update again,
+            # so the next update downloads this period once more
+            started = (iso2datetime(run[1]) if len(run) > 1
+                       else database.last_update or datetime.now())
+        else:
+            last_update = database.last_update
+            last_dt = last_update - timedelta(days=2) if last_update else None
+            started = datetime.now()
+            database.add_checkpoint(
+                'run', [datetime2iso(last_dt) if last_dt else '', datetime2iso(started)])
 
-        last_update = database.last_update
-        last_dt = last_update - timedelta(days=2) if last_update else None
+        return last_dt, started, database.checkpoint('done')
+
+    @staticmethod
+    def _finish_update(database, started):
+        '''Project payments, record the update and forget its checkpoints'''
+
+        print('# Update projected payments')
+        database.update_projected_payments()
+
+        database.mark_update(started)
+        database.clear_checkpoints()
+
+    def _update(self, database):
+        '''Update all data within bulk ingest'''
+
+        last_dt, started, done = self._begin_update(database)
 
         print('# Download wallet')
         database.insert_wallet([self.get_wallet()])
@@ -333,28 +789,34 @@ class Zonky:
         print('# Calculate notification relations')
         database.update_user_notifications_relations()
 
-        print('# Update transactions')
-        transactions = self.get_transactions(from_dt=last_dt)
-        updated_loan_ids = [trans['loanId'] for trans in transactions if trans['loanId']]
-        database.insert_transactions(transactions)
-
-        print('# Download missing loans')
-        missing_loans = [self.get_loan(loan_id) for loan_id in updated_loan_ids]
-        database.insert_loans(missing_loans)
-
-        print('# Download loan investments')
-        loan_investments = list(chain.from_iterable(
-            [self.get_loan_investments(loan_id) for loan_id in updated_loan_ids]))
-        database.insert_loan_investments(loan_investments)
+        if 'transactions' not in done:
+            print('# Update transactions')
+            self._update_pages(
+                database, 'transactions',
+                lambda offset: self.iter_transactions(from_dt=last_dt, offset=offset),
+                lambda transactions: self._insert_transactions(database, transactions))
+
+        if 'loans' not in done:
+            self._skip_complete_loans(database)
+            print('# Download missing loans')
+            self._update_per_loan(database, 'loans', self.get_loan, database.insert_loans)
+
+        if 'loan_investments' not in done:
+            print('# Download loan investments')
+            self._update_per_loan(
+                database, 'loan_investments', self.get_loan_investments,
+                lambda investments: database.insert_loan_investments(
+                    chain.from_iterable(investments)))
 
         print('# Download user investments')
-        database.insert_user_investments(
-            self.get_user_investments(
-                time_type='created',
-                from_dt=last_dt))
-        database.insert_user_investments(
-            self.get_user_investments(
-                time_type='modified',
-                from_dt=last_dt))
-
-        database.mark_update()
+        for time_type in ('created', 'modified'):
+            stage = 'user_investments_{}'.format(time_type)
+            if stage in done:
+                continue
+            self._update_pages(
+                database, stage,
+                lambda offset, time_type=time_type: self.iter_user_investments(
+                    time_type=time_type, from_dt=last_dt, offset=offset),
+                database.insert_user_investments)
+
+        self._finish_update(database, started)
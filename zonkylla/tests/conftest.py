@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Fixtures of tests'''
+
+import pytest
+
+from zonkylla.abstract.singleton_meta import Singleton
+from zonkylla.core.config import Config
+from zonkylla.core.database import DBCreator, DBUpdaterClient
+
+CONFIG = '''
+[zonkylla]
+db_file = {}
+[zonky]
+rate = 1000
+burst = 100
+retries = 0
+'''
+
+
+@pytest.fixture(name='config')
+def config_fixture(tmpdir):
+    '''New configuration with database in temporary directory'''
+
+    Singleton._instances.clear()  # pylint: disable=protected-access
+    config_file = tmpdir.join('zonkylla.conf')
+    config_file.write(CONFIG.format(tmpdir.join('zonkylla.db')))
+
+    yield Config(config_file=str(config_file))
+
+    Singleton._instances.clear()  # pylint: disable=protected-access
+
+
+@pytest.fixture(name='database')
+def database_fixture(config):  # pylint: disable=unused-argument
+    '''Empty database of new configuration'''
+
+    DBCreator().create_if_not_exist()
+    return DBUpdaterClient()
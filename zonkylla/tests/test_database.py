@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Tests of database clients'''
+
+from datetime import timedelta
+
+import pytest
+
+from zonkylla.core import reports
+from zonkylla.core.database import DBModelerClient
+
+INVESTMENTS = [
+    {'id': 1, 'loanId': 1, 'interestRate': 0.1499, 'remainingPrincipal': 1000.0,
+     'remainingMonths': 12, 'nextPaymentDate': '2017-01-31T00:00:00.000+01:00',
+     'paymentStatus': 'OK'},
+    {'id': 2, 'loanId': 2, 'interestRate': 0.0, 'remainingPrincipal': 150.0,
+     'remainingMonths': 3, 'nextPaymentDate': '2017-02-15T00:00:00.000+01:00',
+     'paymentStatus': 'OK'},
+]
+
+
+def test_projected_payments(database):
+    '''Remaining principal is paid by remaining monthly instalments'''
+
+    database.insert_user_investments(INVESTMENTS)
+    assert database.update_projected_payments() == len(INVESTMENTS)
+
+    for investment in INVESTMENTS:
+        payments = database.dbase.execute(
+            'SELECT * FROM z_projected_payments WHERE investmentId = ? ORDER BY paymentNumber',
+            [investment['id']]).fetchall()
+
+        assert len(payments) == investment['remainingMonths']
+        assert [payment['paymentNumber'] for payment in payments] == list(
+            range(1, investment['remainingMonths'] + 1))
+        assert sum(payment['principal'] for payment in payments) == pytest.approx(
+            investment['remainingPrincipal'])
+
+    months = DBModelerClient().monthly_projected_payments()
+    assert [row['month'] for row in months][:4] == ['2017-01', '2017-02', '2017-03', '2017-04']
+    assert sum(row['principal'] for row in months) == pytest.approx(
+        sum(investment['remainingPrincipal'] for investment in INVESTMENTS))
+
+    # nothing changed, nothing is projected again
+    assert database.update_projected_payments() == 0
+
+
+def test_reports_match_projection(database):
+    '''Reports of payments give the same instalments as projection'''
+
+    database.insert_user_investments(INVESTMENTS)
+    database.update_projected_payments()
+    projected = database.dbase.execute(
+        'SELECT COUNT(*) AS count, SUM(principal) AS principal FROM z_projected_payments'
+    ).fetchone()
+
+    transactions = reports.upcoming_transactions()
+    assert len(transactions) == projected['count']
+    assert sum(row['period_to_pay_principal'] for row in transactions) == pytest.approx(
+        projected['principal'])
+
+    calendar = reports.portfolio_payment_calendar()
+    assert len(calendar['payment_number']) == projected['count']
+
+
+@pytest.mark.parametrize('count', [10, 1000])
+def test_complete_loans(database, count):
+    '''Covered loans after deadline fetched recently are complete'''
+
+    database.insert_loans(
+        {'id': loan_id, 'covered': loan_id % 2 == 0,
+         'deadline': '2017-04-01T00:00:00.000+02:00'}
+        for loan_id in range(1, count + 1))
+
+    loan_ids = list(range(count + 10))
+    assert sorted(database.complete_loans(loan_ids, timedelta(days=1))) == list(
+        range(2, count + 1, 2))
+    assert database.complete_loans(loan_ids, timedelta(days=-1)) == []
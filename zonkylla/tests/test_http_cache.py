@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Tests of HTTP cache'''
+
+import requests_mock
+
+from zonkylla.core.zonky import Client
+
+
+def test_cache_is_kept_by_host(config, tmpdir):
+    '''Loan cached from the mock server isn't served for the real one'''
+
+    config.config['http_cache'] = {
+        'file': str(tmpdir.join('zonkylla.cache')),
+        'loans/{id}': '3600',
+    }
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get('https://mock.zonky.test/loans/1', json={'id': 1, 'name': 'mock'})
+        mocker.get('https://api.zonky.test/loans/1', json={'id': 1, 'name': 'real'})
+
+        assert Client('https://mock.zonky.test').get(('loans', '1'))['name'] == 'mock'
+        assert Client('https://api.zonky.test').get(('loans', '1'))['name'] == 'real'
+        # fresh responses are served from cache of their host
+        assert Client('https://mock.zonky.test').get(('loans', '1'))['name'] == 'mock'
+        assert mocker.call_count == 2
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Tests of payment plans'''
+
+from collections import namedtuple
+
+from dateutil.relativedelta import relativedelta
+import pytest
+
+from zonkylla.core import payment_plan
+from zonkylla.core.payment_plan import PaymentPlan, PortfolioPaymentPlan
+
+Investment = namedtuple('Investment', [
+    'id', 'principal_to_pay', 'interest_rate', 'remaining_months', 'next_payment_date'])
+
+INVESTMENTS = [
+    Investment(1, 1000.0, 0.1499, 12, '2017-01-31T00:00:00.000+01:00'),
+    Investment(2, 200.0, 0.0399, 84, '2017-08-15T00:00:00.000+02:00'),
+    Investment(3, 523.37, 0.2749, 1, '2017-12-29T00:00:00.000+01:00'),
+    Investment(4, 100.0, 0.0, 6, '2017-02-28T00:00:00.000+01:00'),
+]
+
+
+def formula_calendar(investment):
+    '''Payment calendar computed by annuity formula in every step'''
+
+    plan = PaymentPlan(investment)
+    monthly_interest = 1 + investment.interest_rate / 12.0
+    term = investment.remaining_months
+    growth = monthly_interest ** term
+    payment = investment.principal_to_pay * growth * (monthly_interest - 1) / (growth - 1)
+
+    return [{
+        'payment_number': i + 1,
+        'paid_total': (i + 1) * payment,
+        'period_to_pay_principal': payment * (1 / monthly_interest ** (term - i)),
+        'period_to_pay_interest': payment * (1 - (1 / monthly_interest ** (term - i))),
+        'payment_date': plan.start_date + relativedelta(months=i),
+    } for i in range(0, term)]
+
+
+@pytest.mark.parametrize('investment', [
+    investment for investment in INVESTMENTS if investment.interest_rate])
+def test_plan_matches_formula(investment):
+    '''Calendar produced by recurrence is the one of annuity formula'''
+
+    calendar = PaymentPlan(investment).payment_calendar
+    expected = formula_calendar(investment)
+
+    assert len(calendar) == len(expected)
+    for row, expected_row in zip(calendar, expected):
+        assert row['payment_number'] == expected_row['payment_number']
+        assert row['payment_date'] == expected_row['payment_date']
+        for column in ('paid_total', 'period_to_pay_principal', 'period_to_pay_interest'):
+            assert row[column] == pytest.approx(expected_row[column])
+
+
+def test_portfolio_numpy_vs_python(monkeypatch):
+    '''Vectorised calendar is the same as the one computed plan by plan'''
+
+    numpy = pytest.importorskip('numpy')
+
+    calendar = PortfolioPaymentPlan(INVESTMENTS).payment_calendar
+    monkeypatch.setattr(payment_plan, 'numpy', None)
+    expected = PortfolioPaymentPlan(INVESTMENTS).payment_calendar
+
+    assert list(calendar) == list(expected)
+    for column in ('investment_id', 'payment_number'):
+        assert calendar[column].tolist() == expected[column]
+    for column in ('paid_total', 'period_to_pay_principal', 'period_to_pay_interest'):
+        assert numpy.allclose(calendar[column], expected[column])
+    assert calendar['payment_date'].astype(object).tolist() == expected['payment_date']
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Tests of update of database from Zonky with an interruption'''
+
+from datetime import datetime
+import re
+
+import pytest
+import requests
+import requests_mock
+
+from zonkylla.core.async_zonky import AsyncZonky
+from zonkylla.core.zonky import Zonky
+
+HOST = 'https://api.zonky.test'
+
+
+class FakeZonky:
+    '''Zonky API serving given transactions and loans'''
+
+    def __init__(self):
+        self.transactions = [self.transaction(1, 1), self.transaction(2, 2)]
+        self.missing_loans = set()
+
+    @staticmethod
+    def transaction(transaction_id, loan_id):
+        '''Payment of the loan'''
+        return {
+            'id': transaction_id, 'amount': 10.0, 'category': 'PAYMENT',
+            'loanId': loan_id, 'orientation': 'IN',
+            'transactionDate': '2017-05-01T10:00:00.000+02:00',
+        }
+
+    @staticmethod
+    def _page(request, context, items):
+        '''Page of items selected by X-Page and X-Size headers'''
+        page = int(request.headers.get('X-Page', 0))
+        size = int(request.headers.get('X-Size', 20))
+        context.headers['X-Total'] = str(len(items))
+        return items[page * size:(page + 1) * size]
+
+    def _loan(self, request, context):
+        loan_id = int(request.path.split('/')[2])
+        if loan_id in self.missing_loans:
+            context.status_code = 404
+            return {'error': 'not found'}
+        return {
+            'id': loan_id, 'name': 'Loan {}'.format(loan_id), 'covered': False,
+            'deadline': '2017-04-01T00:00:00.000+02:00',
+        }
+
+    def mock(self, mocker):
+        '''Register endpoints in requests_mock.Mocker'''
+
+        mocker.post(HOST + '/oauth/token', json={
+            'access_token': 'token', 'token_type': 'bearer', 'expires_in': 300,
+            'refresh_token': 'refresh', 'scope': 'SCOPE_APP_WEB'})
+        mocker.get(HOST + '/users/me/wallet', json={'id': 1, 'balance': 10.0})
+        mocker.get(HOST + '/users/me/wallet/blocked-amounts', json=[])
+        mocker.get(HOST + '/users/me/notifications', json=[])
+        mocker.get(HOST + '/users/me/wallet/transactions',
+                   json=lambda request, context: self._page(
+                       request, context, self.transactions))
+        mocker.get(HOST + '/users/me/investments',
+                   json=lambda request, context: self._page(request, context, []))
+        mocker.get(re.compile(r'/loans/\d+$'), json=self._loan)
+        mocker.get(re.compile(r'/loans/\d+/investments$'),
+                   json=lambda request, context: self._page(request, context, []))
+
+
+def ids(database, table):
+    '''IDs of rows of the table'''
+    sql = 'SELECT id FROM {} ORDER BY id'.format(table)
+    return [row['id'] for row in database.dbase.execute(sql).fetchall()]
+
+
+@pytest.mark.parametrize('zonky_class', [Zonky, AsyncZonky])
+def test_resume_interrupted_update(database, zonky_class):
+    '''Interrupted update is finished by the next one, sync or async'''
+
+    api = FakeZonky()
+    api.missing_loans.add(2)
+
+    with requests_mock.Mocker() as mocker:
+        api.mock(mocker)
+
+        started = datetime.now()
+        with pytest.raises(requests.HTTPError):
+            Zonky(HOST, 'user', 'password').update(database)
+        assert database.checkpoint('done') == ['transactions']
+
+        api.missing_loans.clear()
+        resumed = datetime.now()
+        zonky_class(HOST, 'user', 'password').update(database)
+
+        assert ids(database, 'a_loans') == [1, 2]
+        assert not database.dbase.execute('SELECT * FROM z_checkpoints').fetchall()
+        # the start of the interrupted run is recorded as the time of update
+        assert started <= database.last_update < resumed
+
+        api.transactions.append(api.transaction(999, 3))
+        Zonky(HOST, 'user', 'password').update(database)
+
+    assert ids(database, 'a_transactions') == [1, 2, 999]
+    assert ids(database, 'a_loans') == [1, 2, 3]
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017  zonkylla Contributors see COPYING for license
+
+'''Tests of Zonky clients'''
+
+import pytest
+import requests
+import requests_mock
+
+from zonkylla.core.zonky import Client
+
+HOST = 'https://api.zonky.test'
+
+
+@pytest.mark.parametrize('method', ['post', 'patch', 'delete'])
+def test_invalid_request_sent_once(config, method):  # pylint: disable=unused-argument
+    '''Page size isn't negotiated by requests which aren't idempotent'''
+
+    with requests_mock.Mocker() as mocker:
+        mocker.register_uri(method.upper(), HOST + '/loans/1', status_code=400)
+
+        with pytest.raises(requests.HTTPError):
+            getattr(Client(HOST), method)(('loans', '1'))
+        assert mocker.call_count == 1
+
+
+def test_invalid_get_is_probed_once(config):  # pylint: disable=unused-argument
+    '''Invalid GET is repeated only once with smaller page'''
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get(HOST + '/loans/marketplace', status_code=400)
+
+        with pytest.raises(requests.HTTPError):
+            Client(HOST).get(('loans', 'marketplace'))
+        assert [request.headers['X-Size'] for request in mocker.request_history] == [
+            '1000', '500']
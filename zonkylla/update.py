@@ -6,13 +6,17 @@
 '''Data update by zonky'''
 
 from .core.zonky import Zonky
+from .core.async_zonky import AsyncZonky
 from .core.database import DBUpdaterClient
 
 
-def update_from_zonky(host, username, password):
+def update_from_zonky(host, username, password, asynchronous=False):
     """Update all data for user from zonky"""
 
-    zonky = Zonky(host, username, password)
+    if asynchronous:
+        zonky = AsyncZonky(host, username, password)
+    else:
+        zonky = Zonky(host, username, password)
     database = DBUpdaterClient()
 
     zonky.update(database)